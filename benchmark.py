@@ -0,0 +1,445 @@
+"""Замеры этапов миграции на синтетическом пакете.
+
+Генерирует пакет MD_MAINS.DBF/MD_GOODS.DBF и дерево TIFF-картинок
+нужного размера, по очереди гоняет этапы migration_script и пишет для
+каждого время, скорость и пиковую память. С --pg дополнительно заливает
+строки в локальную одноразовую PostgreSQL (схема migration_benchmark).
+Результаты сохраняются в JSON и сравниваются с прошлым прогоном:
+
+    python benchmark.py --size 100000 --images 2000
+    python benchmark.py --size 100000 --compare prev.json
+    python benchmark.py --size 10000 --pg "dbname=bench user=postgres"
+"""
+import argparse
+import datetime
+import gc
+import json
+import logging
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import psycopg2
+from psycopg2.extensions import parse_dsn
+from PIL import Image
+
+import migration_script as ms
+
+
+BENCHMARK_DIRECTORY = '{}sync/benchmarks/'.format(ms.IMPORT_DIRECTORY)
+PACKAGE_DIRECTORY = os.path.join(
+    tempfile.gettempdir(), 'migration_benchmark')
+PG_SCHEMA = 'migration_benchmark'
+PHASES = ('collect', 'attrs', 'import', 'images', 'load')
+IMAGE_SIZE = (400, 300)
+ATTRS_SAMPLE = 20000  # записей для замера create_attrs
+IMAGES_SAMPLE = 200  # картинок для замера import_image
+SEED = 101
+
+# Поля синтетического MD_MAINS.DBF: имя, тип, длина
+MAINS_FIELDS = (
+    ('NSER', 'N', 10), ('NTM', 'C', 12), ('NAP', 'C', 12),
+    ('DAP', 'D', 8), ('DPUB', 'D', 8), ('DEX', 'D', 8),
+    ('DAPK', 'D', 8), ('DAPV', 'D', 8), ('IS', 'C', 1), ('WCD', 'C', 1),
+    ('CU', 'C', 2), ('SDACT', 'C', 10), ('SDIZM', 'D', 8),
+    ('OWN', 'C', 200), ('OWN2', 'C', 200), ('NPP', 'C', 200),
+    ('MAIL2', 'C', 200), ('KPP', 'C', 20), ('NPARENT', 'C', 12),
+    ('GS', 'C', 60), ('EXPRTNAME', 'C', 100),
+)
+GOODS_FIELDS = (('NSER', 'N', 10), ('GOODS', 'C', 254))
+PG_TABLES = """
+    CREATE TABLE IF NOT EXISTS {schema}."Objects" (
+        "Number" text PRIMARY KEY, "Kind" integer, "ParentNumber" text,
+        "StructureID" text, "UpdateDate" timestamp,
+        "CreatedDate" timestamp, "State" text,
+        "OperStoragePeriod" timestamp, "TempStoragePeriod" timestamp,
+        "ClassType" text, "LastStoragePeriod" timestamp, "Version" text,
+        "Received" timestamp
+    );
+    CREATE INDEX IF NOT EXISTS "Objects_ParentNumber"
+        ON {schema}."Objects" ("ParentNumber");
+    CREATE TABLE IF NOT EXISTS {schema}."SearchAttributes" (
+        "ID" text PRIMARY KEY, "Name" text,
+        "ParentNumber" text REFERENCES {schema}."Objects" ("Number")
+            ON DELETE CASCADE,
+        "ParentAttrId" text, "Kind" integer, "CreatedBy" text,
+        "CreatedDate" timestamp, "TextValue" text, "IntValue" bigint,
+        "DateValue" timestamp, "GuidValue" text
+    );
+    CREATE INDEX IF NOT EXISTS "SearchAttributes_ParentNumber"
+        ON {schema}."SearchAttributes" ("ParentNumber");
+"""
+PG_CONNECTION_KEYS = ('dbname', 'user', 'password', 'host', 'port')
+
+
+def write_dbf(path, fields, count, rows):
+    """Пишет DBF III с кодовой страницей 866, строки берутся из генератора."""
+    header_length = 32 + 32 * len(fields) + 1
+    record_length = 1 + sum(length for _, _, length in fields)
+    today = datetime.date.today()
+    with open(path, 'wb') as dbf:
+        dbf.write(struct.pack(
+            '<BBBBIHH17xB2x', 3, today.year - 1900, today.month, today.day,
+            count, header_length, record_length, 0x65))
+        for name, field_type, length in fields:
+            dbf.write(struct.pack(
+                '<11sc4xBB14x', name.encode('ascii'),
+                field_type.encode('ascii'), length, 0))
+        dbf.write(b'\r')
+        for row in rows:
+            data = bytearray(b' ')
+            for name, field_type, length in fields:
+                value = row.get(name)
+                if field_type == 'N':
+                    data += str(value).rjust(length).encode('ascii')
+                elif field_type == 'D':
+                    data += (value.strftime('%Y%m%d') if value
+                             else '').ljust(8).encode('ascii')
+                else:
+                    data += (value or '').encode(
+                        'cp866', 'replace')[:length].ljust(length)
+            dbf.write(data)
+        dbf.write(b'\x1a')
+
+
+def synthetic_record(nser, rnd):
+    """Запись MD_MAINS со всеми видами ОИС из thread()."""
+    number = '{:06d}'.format(nser % 1000000)
+    if nser % 20 == 0:  # WKTrademark
+        ntm, is_, wcd = '999' + number + '01', '', ''
+    elif nser % 17 == 0:  # Madrid
+        ntm, is_, wcd = number + '01', 'I', ''
+    elif nser % 13 == 0:  # наименования мест происхождения
+        ntm, is_, wcd = number + rnd.choice(('00', '01')), '', 'N'
+    else:
+        ntm, is_, wcd = number + '01', '', ''
+    day = datetime.date(1995, 1, 1) + datetime.timedelta(nser % 9000)
+    return {
+        'NSER': nser, 'NTM': ntm, 'NAP': '20{:08d}'.format(nser),
+        'DAP': day, 'DPUB': day + datetime.timedelta(400),
+        'DEX': day + datetime.timedelta(3650),
+        'DAPK': day if nser % 3 else None, 'DAPV': None,
+        'IS': is_, 'WCD': wcd, 'CU': 'RU', 'SDACT': 'ДЕЙСТВ',
+        'SDIZM': day + datetime.timedelta(30),
+        'OWN': 'ООО "Компания {}"'.format(nser) if nser % 11 else '',
+        'OWN2': "O'Brien & Co {}".format(nser) if nser % 7 == 0 else '',
+        'NPP': 'Патентный поверенный {}'.format(rnd.randint(1, 5000))
+        if nser % 2 else '',
+        'MAIL2': '{} г. Москва, ул. Тверская, д. {}'.format(
+            100000 + nser % 900000, nser % 300),
+        'KPP': '{:09d}'.format(rnd.randint(0, 10 ** 9 - 1)),
+        'NPARENT': '', 'GS': '1 3 5 {}'.format(nser % 45 + 1),
+        'EXPRTNAME': 'Эксперт {}'.format(nser % 50),
+    }
+
+
+def synthetic_goods(nser, rnd):
+    words = ('одежда', 'обувь', 'головные уборы', 'услуги', 'реклама',
+             'программное обеспечение', 'напитки', 'продукты')
+    return {'NSER': nser, 'GOODS': '  '.join(
+        rnd.choice(words) for _ in range(rnd.randint(3, 25)))}
+
+
+def image_nsers(size, images):
+    if not images:
+        return []
+    step = max(size // images, 1)
+    return list(range(1, size + 1, step))[:images]
+
+
+def generate_package(directory, size, images):
+    """Создаёт пакет, если в каталоге нет пакета тех же размеров."""
+    marker = os.path.join(directory, 'benchmark.json')
+    params = {'size': size, 'images': images, 'seed': SEED}
+    if os.path.isfile(marker):
+        with open(marker, encoding='utf-8') as marker_file:
+            if json.load(marker_file) == params:
+                logging.info('Пакет {} уже создан'.format(directory))
+                return
+    os.makedirs(directory, exist_ok=True)
+    logging.info('Создаём пакет: {} записей, {} картинок'.format(
+        size, images))
+    rnd = random.Random(SEED)
+    write_dbf(
+        os.path.join(directory, 'MD_MAINS.DBF'), MAINS_FIELDS, size,
+        (synthetic_record(nser, rnd) for nser in range(1, size + 1)))
+    write_dbf(
+        os.path.join(directory, 'MD_GOODS.DBF'), GOODS_FIELDS, size,
+        (synthetic_goods(nser, rnd) for nser in range(1, size + 1)))
+    base = Image.linear_gradient('L').resize(IMAGE_SIZE).convert('RGB')
+    images_path = directory + "\\IMG\\"  # как в ms.index_images()
+    for nser in image_nsers(size, images):
+        folder = os.path.join(images_path, '{:04d}'.format(nser // 1000))
+        os.makedirs(folder, exist_ok=True)
+        image = base.copy()
+        # у каждой картинки своё содержимое, иначе сработает кэш JPEG
+        for x in range(16):
+            image.putpixel((x, 0), (nser >> x & 1) * 255)
+        image.save(os.path.join(folder, '{}.TIF'.format(nser)), 'TIFF')
+    with open(marker, 'w', encoding='utf-8') as marker_file:
+        json.dump(params, marker_file)
+
+
+def measure(results, phase, func, unit, trace_memory):
+    """Выполняет этап, func возвращает (результат, количество единиц)."""
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    result, count = func()
+    elapsed = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        peak = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        tracemalloc.stop()
+    results.append({
+        'phase': phase, 'count': count, 'unit': unit,
+        'seconds': round(elapsed, 3),
+        'per_second': round(count / elapsed, 1) if elapsed else None,
+        'peak_mb': peak,
+    })
+    logging.info('{}: {} {} за {:.2f} с, {:.0f} {}/с, пик {} МБ'.format(
+        phase, count, unit, elapsed, count / elapsed if elapsed else 0,
+        unit, peak if peak is not None else '-'))
+    return result
+
+
+def without_images(records):
+    """Копии записей без картинок: thread() меняет запись на месте."""
+    return {
+        nser: {key: value for key, value in record.items()
+               if not key.startswith('IMAGE_')}
+        for nser, record in records.items()
+    }
+
+
+def clear_rows():
+    for rows in (ms.STORAGE_OBJECTS, ms.NODE_VALUES, ms.NODE_NO_PARENT_VALUES,
+                 ms.ATTRS_VALUES, ms.SUPERSEDED_ROOT_OBJECTS,
+                 ms.SUPERSEDED_INNER_OBJECTS, ms.COMPLETED_RECORDS):
+        del rows[:]
+
+
+def row_count():
+    return (len(ms.STORAGE_OBJECTS) + len(ms.NODE_VALUES)
+            + len(ms.NODE_NO_PARENT_VALUES) + len(ms.ATTRS_VALUES))
+
+
+def bench_collect(results, directory, trace_memory):
+    index = os.path.join(directory, 'MD_MAINS.DBF' + ms.DBF_INDEX_SUFFIX)
+    if os.path.exists(index):
+        os.remove(index)
+
+    def run():
+        records = ms.collect_data(directory)
+        return records, len(records)
+
+    for phase in ('collect_data', 'collect_data (с индексом)'):
+        records = measure(results, phase, run, 'записей', trace_memory)
+    return records
+
+
+def bench_attrs(results, records, trace_memory):
+    sample = list(without_images(records).values())[:ATTRS_SAMPLE]
+
+    def run():
+        ms.ROW_BATCH.batch = batch = ms.RowBatch()
+        root_obj_id = ms.new_id()
+        for record in sample:
+            ms.create_attrs(root_obj_id, ms.new_id(), record, 'RUTrademark')
+        ms.ROW_BATCH.batch = None
+        return batch, len(batch.attrs_values)
+
+    measure(results, 'create_attrs', run, 'строк', trace_memory)
+
+
+def bench_import(results, records, trace_memory):
+    def run():
+        clear_rows()
+        ms.import_data(without_images(records))
+        return None, row_count()
+
+    measure(results, 'import_data', run, 'строк', trace_memory)
+
+
+def bench_images(results, records, directory, trace_memory):
+    jobs = [
+        (record['IMAGE_PATH'], datetime.datetime.now(), ms.new_id(),
+         ms.new_id(), record['IMAGE_NAME'], record['IMAGE_TYPE'])
+        for record in records.values() if 'IMAGE_PATH' in record
+    ][:IMAGES_SAMPLE]
+    if not jobs:
+        raise RuntimeError(
+            'В пакете {} не найдено картинок: проверьте --images '
+            'и каталог IMG'.format(directory))
+    ms.DESTINATION = os.path.join(directory, 'export') + os.sep
+    ms.IMAGE_CACHE = False
+
+    def run():
+        for job in jobs:
+            ms.import_image(*job)
+        return None, len(jobs)
+
+    measure(results, 'import_image', run, 'картинок', trace_memory)
+
+
+def prepare_pg(dsn):
+    """Создаёт таблицы в отдельной схеме и направляет туда пул соединений.
+
+    Хост обязателен, остальные параметры соединения берутся только из DSN,
+    чтобы пул не подхватил настройки рабочей базы из окружения.
+    """
+    params = parse_dsn(dsn)
+    if not params.get('host'):
+        raise ValueError(
+            'В --pg не указан host: этап load очищает таблицы, '
+            'нужна явно заданная одноразовая база')
+    with psycopg2.connect(dsn) as conn:
+        with conn.cursor() as cur:
+            cur.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(PG_SCHEMA))
+            cur.execute(PG_TABLES.format(schema=PG_SCHEMA))
+    conn.close()
+    for key in PG_CONNECTION_KEYS:
+        if key in params:
+            os.environ[key] = params[key]
+        else:
+            os.environ.pop(key, None)
+    os.environ['PGOPTIONS'] = '-c search_path={}'.format(PG_SCHEMA)
+
+
+def truncate_pg():
+    conn, cur = ms.connect_to_database(local=False)
+    try:
+        cur.execute('TRUNCATE {0}."Objects", {0}."SearchAttributes"'.format(
+            PG_SCHEMA))
+        conn.commit()
+    finally:
+        ms.release_connection(conn)
+
+
+def bench_load(results, records, trace_memory):
+    clear_rows()
+    ms.import_data(without_images(records))
+    rows = (ms.STORAGE_OBJECTS, ms.NODE_NO_PARENT_VALUES, ms.NODE_VALUES,
+            ms.ATTRS_VALUES)
+    for method, staged in (('batch', False), ('copy', False),
+                           ('copy', True)):
+        ms.LOAD_METHOD = method
+        truncate_pg()
+
+        def run():
+            conn, _ = ms.connect_to_database(local=False)
+            try:
+                if staged:
+                    ms.load_rows_staged(conn, *rows)
+                else:
+                    ms.load_rows(conn, *rows)
+            finally:
+                ms.release_connection(conn)
+            return None, row_count()
+
+        measure(results, 'load_rows {}{}'.format(
+            method, ' через временные таблицы' if staged else ''),
+            run, 'строк', trace_memory)
+    measure(results, 'prefetch', lambda: (
+        ms.prefetch(records), len(records)), 'записей', trace_memory)
+    # повторный перенос: заменяемые объекты удаляются вместе с атрибутами
+    clear_rows()
+    ms.import_data(without_images(records))
+
+    def rewrite():
+        conn, _ = ms.connect_to_database(local=False)
+        try:
+            ms.load_rows(conn, *rows, ms.SUPERSEDED_INNER_OBJECTS,
+                         ms.SUPERSEDED_ROOT_OBJECTS)
+        finally:
+            ms.release_connection(conn)
+        return None, row_count()
+
+    measure(results, 'load_rows перезапись', rewrite, 'строк', trace_memory)
+    ms.close_pools()
+
+
+def compare(results, previous_path):
+    with open(previous_path, encoding='utf-8') as previous_file:
+        previous = {
+            phase['phase']: phase
+            for phase in json.load(previous_file)['phases']
+        }
+    for phase in results:
+        before = previous.get(phase['phase'])
+        if not before or not before['per_second'] or not phase['per_second']:
+            continue
+        change = (phase['per_second'] / before['per_second'] - 1) * 100
+        logging.info('{}: {:.0f} -> {:.0f} {}/с ({:+.1f}%){}'.format(
+            phase['phase'], before['per_second'], phase['per_second'],
+            phase['unit'], change, '  <-- медленнее' if change < -10 else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=10000,
+                        help='записей в пакете: 10000, 100000, 1000000')
+    parser.add_argument('--images', type=int, default=1000,
+                        help='картинок в пакете')
+    parser.add_argument('--directory', help='каталог синтетического пакета')
+    parser.add_argument('--phases', default=','.join(PHASES),
+                        help='этапы через запятую: ' + ', '.join(PHASES))
+    parser.add_argument('--pg', metavar='DSN',
+                        help='одноразовая PostgreSQL для этапа load')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='не замерять память (tracemalloc замедляет)')
+    parser.add_argument('--output', help='файл результатов JSON')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='результаты прошлого прогона для сравнения')
+    args = parser.parse_args()
+    phases = set(args.phases.split(','))
+    trace_memory = not args.no_memory
+    directory = args.directory or os.path.join(
+        PACKAGE_DIRECTORY, str(args.size))
+    ms.setup_logging()
+    ms.ROW_LOGGER.setLevel(logging.WARNING)
+    ms.NSER_START, ms.NSER_END = 0, args.size + 1
+    generate_package(directory, args.size, args.images)
+    results = []
+    records = bench_collect(results, directory, trace_memory)
+    if 'attrs' in phases:
+        bench_attrs(results, records, trace_memory)
+    if 'import' in phases:
+        bench_import(results, records, trace_memory)
+    if 'images' in phases:
+        bench_images(results, records, directory, trace_memory)
+    if 'load' in phases:
+        if args.pg:
+            prepare_pg(args.pg)
+            bench_load(results, records, trace_memory)
+        else:
+            logging.info('Этап load пропущен: не задан --pg')
+    clear_rows()
+    output = args.output or os.path.join(
+        BENCHMARK_DIRECTORY, '{}_{}.json'.format(
+            args.size, datetime.datetime.now().strftime('%Y-%m-%d_%H-%M')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as output_file:
+        json.dump({
+            'size': args.size, 'images': args.images,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'settings': {
+                name: getattr(ms, name) for name in (
+                    'EXECUTOR_MODE', 'WORKERS', 'RECORDS_CHUNK_SIZE',
+                    'BATCH_PAGE_SIZE', 'COPY_CHUNK_SIZE', 'ID_FORMAT')
+            },
+            'phases': results,
+        }, output_file, ensure_ascii=False, indent=2)
+    logging.info('Результаты сохранены в {}'.format(output))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
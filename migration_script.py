@@ -1,17 +1,38 @@
+import argparse
+import atexit
+import bisect
+import contextlib
+import cProfile
 import datetime
+import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
 import os
+import pstats
+import queue
+import shutil
 import sys
 import time
 import uuid
 import threading
-from logging.handlers import RotatingFileHandler
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 import psycopg2
-from psycopg2 import extras
+from psycopg2 import extensions, extras
 from dbfread import DBF
+from dbfread.memo import FakeMemoFile, open_memofile
 from PIL import Image
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
 
 # Общие настройки
 PACKAGE = '101'
@@ -65,31 +86,161 @@ ATTRS_QUERY = """
     (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
 """
 ATTRS_VALUES = []
+STORAGE_OBJECTS_COPY = """
+    COPY "Objects"
+    ("Number", "Kind", "ParentNumber", "StructureID",
+    "UpdateDate", "CreatedDate", "State",
+    "OperStoragePeriod", "TempStoragePeriod",
+    "ClassType", "LastStoragePeriod", "Version",
+    "Received")
+    FROM STDIN WITH (FORMAT text, ENCODING 'UTF8')
+"""
+NODE_COPY = """
+    COPY "SearchAttributes"
+    ("ID", "Name", "ParentNumber", "ParentAttrId",
+    "Kind", "CreatedBy", "CreatedDate", "GuidValue")
+    FROM STDIN WITH (FORMAT text, ENCODING 'UTF8')
+"""
+NODE_NO_PARENT_COPY = """
+    COPY "SearchAttributes"
+    ("ID", "Name", "ParentNumber",
+    "Kind", "CreatedBy", "CreatedDate", "GuidValue")
+    FROM STDIN WITH (FORMAT text, ENCODING 'UTF8')
+"""
+ATTRS_COPY = """
+    COPY "SearchAttributes"
+    ("ID", "CreatedDate", "ParentNumber",
+    "ParentAttrId", "Name", "Kind",
+    "TextValue", "IntValue", "DateValue",
+    "GuidValue", "CreatedBy")
+    FROM STDIN WITH (FORMAT text, ENCODING 'UTF8')
+"""
 CREATED_BY = 'EA_Migration_{}'.format(PACKAGE)
 NONETYPE = type(None)
 
-# Счётчики ОИС
+# Счётчики ОИС, итоги обработчиков переносит update_counts()
 TMK_COUNT = 0
 WK_COUNT = 0
 MDRD_COUNT = 0
 APL_COUNT = 0
 APLCERT_COUNT = 0
 
-# Настройки логгирования
-CONSOLE_HANDLER = logging.StreamHandler()
-LOG_HANDLER = RotatingFileHandler(
-    '{}sync/logs/{}_{}.log'.format(
-        IMPORT_DIRECTORY, PACKAGE,
-        datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
-    ),
-    mode='a', maxBytes=50*1024*1024,
-    backupCount=100, encoding='utf-8', delay=0)
-logging.basicConfig(
-    handlers=(LOG_HANDLER, CONSOLE_HANDLER),
-    format='[%(asctime)s | %(levelname)s]: %(message)s',
-    datefmt=TIME_FORMAT,
-    level=logging.INFO
-)
+# Ранее перенесённые записи, заполняются в prefetch()
+PREFETCH_ITERSIZE = 10000
+ATTRS_BY_RETRO_NUMBER = {}  # NSER -> (ParentNumber, ParentAttrId)
+ATTRS_BY_APPL_NUMBER = {}  # NTM -> (ParentNumber, ParentAttrId)
+OBJECTS_BY_PARENT = {}  # ParentNumber -> Number
+WORKER_PROCESS = False  # True в процессе-обработчике, ставит init_worker()
+SUPERSEDED_ROOT_OBJECTS = []  # удаляются в транзакции загрузки
+SUPERSEDED_INNER_OBJECTS = []
+COMPLETED_RECORDS = []  # NSER записей, строки которых построены без ошибок
+
+# Настройки обработки записей
+# 'thread' - много картинок, 'process' - много строк,
+# 'serial' - без обработчиков, для сверки результата
+EXECUTOR_MODE = 'thread'
+WORKERS = os.cpu_count() or 4
+RECORDS_CHUNK_SIZE = 500  # записей в одной задаче обработчика
+ROW_BATCH = threading.local()
+# 'uuid7' - упорядоченные по времени, 'uuid1' - как раньше
+ID_FORMAT = 'uuid7'
+ID_BATCH_SIZE = 4096  # идентификаторов в запасе у одного потока, до 4096
+ID_BUFFER = threading.local()
+NSER_START = 0
+NSER_END = 1000000
+
+# Чтение DBF
+DBF_INDEX = True  # хранить индекс NSER -> номер записи рядом с MD_MAINS.DBF
+DBF_INDEX_SUFFIX = '.nser'
+DBF_INDEX_VERSION = 2  # формат файла индекса: пары NSER и номер записи
+# Поля MD_MAINS.DBF, которые читаются помимо полей из ATTRS_SCHEMA
+RECORD_FIELDS = ('NSER', 'NTM', 'DAP', 'IS', 'WCD', 'OWN', 'NPP', 'GOODS')
+IMAGE_TYPES = {'TIF': 'TIFF', 'TIFF': 'TIFF', 'JPG': 'JPEG', 'JPEG': 'JPEG'}
+IMAGE_INDEX = True  # хранить индекс каталога IMG между запусками
+IMAGE_INDEX_NAME = 'IMG.index.json'
+IMAGE_INDEX_WORKERS = 8
+
+# Потоковый режим: чтение DBF, обработка и загрузка идут одновременно
+PIPELINE_MODE = 'batch'  # 'batch' - весь пакет в памяти, 'stream' - пачками
+STREAM_CHUNK_SIZE = 20000  # записей DBF в одной пачке потокового режима
+STREAM_QUEUE_SIZE = 8  # пачек строк, ожидающих загрузки
+
+# Перенос диапазонами NSER с продолжением после сбоя
+CHECKPOINT = False
+CHECKPOINT_RANGE_SIZE = 10000  # NSER в одном диапазоне
+CHECKPOINT_FILE = '{}sync/checkpoints/{}_{}.json'.format(
+    IMPORT_DIRECTORY, PACKAGE, DB_FILE)
+
+# Перенос только новых и изменившихся записей
+DELTA = False
+DELTA_FILE = '{}sync/fingerprints/{}_{}.json'.format(
+    IMPORT_DIRECTORY, PACKAGE, DB_FILE)
+
+# 'inline' - картинки в обработчике записи,
+# 'pool' - в отдельном пуле процессов, параллельно с генерацией строк
+IMAGE_MODE = 'inline'
+IMAGE_WORKERS = os.cpu_count() or 4
+IMAGE_EXECUTOR = None
+JPEG_QUALITY = 80
+# Кэш JPEG-версий картинок между запусками, ключ - хэш исходника
+IMAGE_CACHE = True
+IMAGE_CACHE_DIRECTORY = '{}sync/image_cache/'.format(IMPORT_DIRECTORY)
+IMAGE_CACHE_SIZE = 10 * 1024 * 1024 * 1024  # байт
+IMAGE_CACHE_ORPHAN_AGE = 3600  # секунд до удаления файлов без пары
+
+# Пул соединений с БД
+POOL_MIN_SIZE = 1  # соединений, открываемых при создании пула
+POOL_MAX_SIZE = 8
+POOL_HEALTH_CHECK = True  # SELECT 1 перед выдачей соединения
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+CONNECTION_POOLS = {}  # id соединения -> пул
+
+# Настройки загрузки
+LOAD_METHOD = 'batch'  # 'batch' - execute_batch, 'copy' - COPY FROM STDIN
+BATCH_PAGE_SIZE = 2000
+COPY_CHUNK_SIZE = 500000  # строк в одной команде COPY, 0 - вся таблица
+DELETE_BATCH_SIZE = 10000
+# >1 - пачки параллельно заливаются во временные таблицы по нескольким
+# соединениям, в основные таблицы переносятся одной транзакцией;
+# не больше POOL_MAX_SIZE - 1, одно соединение занято переносом
+LOAD_CONNECTIONS = 1
+LOAD_CHUNK_SIZE = 100000  # строк в одной пачке параллельной загрузки
+# Залив больших пакетов через UNLOGGED-таблицы и один INSERT ... SELECT
+STAGING_LOAD = False
+# пересоздать необязательные индексы после переноса; только для пакетного
+# режима без CHECKPOINT, где загрузка одна на весь прогон
+STAGING_DROP_INDEXES = False
+STAGING_TABLES = {
+    '"Objects"': '"Objects_staging_{}"'.format(PACKAGE),
+    '"SearchAttributes"': '"SearchAttributes_staging_{}"'.format(PACKAGE),
+}
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'
+})
+
+# Настройки логгирования, включаются setup_logging() в основном процессе
+LOG_FORMATTER = logging.Formatter(
+    '[%(asctime)s | %(levelname)s]: %(message)s', datefmt=TIME_FORMAT)
+CONSOLE_HANDLER = None
+LOG_HANDLER = None
+# Запись в файл и консоль идёт в отдельном потоке, обработчики не ждут
+LOG_QUEUE = queue.SimpleQueue()
+LOG_LISTENER = None
+WORKER_LOG_QUEUE = None  # для процессов-обработчиков
+WORKER_LOG_LISTENER = None
+# 'rows' - сообщение на каждую строку, 'summary' - только сводки
+LOG_MODE = 'rows'
+PROGRESS_INTERVAL = 60  # секунд между сводками
+# Метрики этапов в JSON и формате Prometheus, пишутся в конце migrate()
+METRICS_DIRECTORY = '{}sync/metrics/'.format(IMPORT_DIRECTORY)
+# Профилирование: '' - выключено, 'cprofile' - cProfile в одном потоке,
+# 'sample' - периодический снимок стеков всех потоков
+PROFILE = os.environ.get('MIGRATION_PROFILE', '')
+PROFILE_INTERVAL = 0.01  # секунд между снимками стеков
+PROFILE_DIRECTORY = '{}sync/logs/'.format(IMPORT_DIRECTORY)
+ROW_LOGGER = logging.getLogger('migration.rows')
+ROW_LOGGER.setLevel(logging.INFO if LOG_MODE == 'rows' else logging.WARNING)
 DATA_TYPES = {
     NONETYPE: [0, 'TextValue'],
     str: [0, 'TextValue'],
@@ -100,253 +251,779 @@ DATA_TYPES = {
     bool: [4, 'BoolValue'],
     uuid.UUID: [6, 'GuidValue']
 }
+# Схема атрибутов: атрибут -> поле записи DBF, константа или особое значение
+NODE_UID = object()  # идентификатор узла таблицы
+UPDATE_TIME = object()  # время создания атрибутов
+ATTRS_SCHEMA = {
+    'RUTrademark': {
+        'rutmk_uid': NODE_UID,
+        'appl_doc_link': None,
+        'appl_ui_link': None,
+        'appl_type': None,
+        'appl_receiving_date': None,
+        'appl_number': 'NAP',
+        'appl_date': 'DAP',
+        'reg_ui_link': None,
+        'reg_doc_link': None,
+        'reg_number': 'NTM',
+        'reg_date': 'DPUB',
+        'reg_country': 'CU',
+        'reg_publ_number': None,
+        'reg_publ_date': None,
+        'status_code': 'SDACT',
+        'status_date': 'SDIZM',
+        'expiry_date': 'DEX',
+        'seniority_priority_number': None,
+        'seniority_priority_date': None,
+        'priority_date': 'DAPK',
+        'exhib_priority_date': 'DAPV',
+        'divisional_appl_number': 'NPARENT',
+        'divisional_appl_date': None,
+        'other_date': None,
+        'corr_address': 'MAIL2',
+        'corr_address_country': None,
+        'applicants': None,
+        'applicants_count': None,
+        'holders': 'OWN2',
+        'holders_count': None,
+        'representatives': 'NPP',
+        'representatives_count': None,
+        'representative_number': 'KPP',
+        'representatives_term': None,
+        'users': None,
+        'users_count': None,
+        'mark_category': None,
+        'representation_names': 'IMAGE_NAME',
+        'search_result': None,
+        'goods': 'GS',
+        'prev_reg_number': None,
+        'prev_reg_date': None,
+        'prev_reg_country': None,
+        'feature_description': None,
+        'disclaimers': None,
+        'association_marks': None,
+        'payment': None,
+        'records': None,
+        'corr_type': None,
+        'corr_method': None,
+        'sheets_count': None,
+        'image_sheets_count': None,
+        'payment_doc_count': None,
+        'is_external_search': None,
+        'outgoing_correspondence': None,
+        'responsible_expert': 'EXPRTNAME',
+        'retro_number': 'NSER',
+        'update_time': UPDATE_TIME,
+        'delete_time': None
+    },
+}
+ATTRS_PLANS = {}
+WRONG_VALUES = frozenset(['TM_DAT__', 'NSER', 'NAP', 'NAPTW',
+                          'TWICE', 'DAP', 'CU', 'IS', 'WCD'])
+# Тип значения -> (Kind, индекс колонки значения в строке ATTRS_QUERY)
+VALUE_SLOTS = {
+    NONETYPE: (DATA_TYPES[NONETYPE][0], None),
+    str: (DATA_TYPES[str][0], 6),
+    int: (DATA_TYPES[int][0], 7),
+    datetime.date: (DATA_TYPES[datetime.date][0], 8),
+    datetime.datetime: (DATA_TYPES[datetime.datetime][0], 8),
+    uuid.UUID: (DATA_TYPES[uuid.UUID][0], 9),
+}
+# Kind -> индекс колонки значения, строки атрибутов хранят только значение
+KIND_COLUMNS = {kind: column for kind, column in VALUE_SLOTS.values()
+                if column}
+
+
+def setup_logging():
+    """Открывает лог в файл и консоль и запускает поток записи.
+
+    Вызывается только в основном процессе: процессы-обработчики при
+    импорте модуля не открывают файл лога и не запускают свой поток,
+    а пишут в общую очередь (init_logging).
+    """
+    global CONSOLE_HANDLER, LOG_HANDLER, LOG_LISTENER
+    if LOG_LISTENER is not None:
+        return
+    CONSOLE_HANDLER = logging.StreamHandler()
+    LOG_HANDLER = RotatingFileHandler(
+        '{}sync/logs/{}_{}.log'.format(
+            IMPORT_DIRECTORY, PACKAGE,
+            datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
+        ),
+        mode='a', maxBytes=50*1024*1024,
+        backupCount=100, encoding='utf-8', delay=True)
+    CONSOLE_HANDLER.setFormatter(LOG_FORMATTER)
+    LOG_HANDLER.setFormatter(LOG_FORMATTER)
+    LOG_LISTENER = QueueListener(LOG_QUEUE, LOG_HANDLER, CONSOLE_HANDLER)
+    logging.basicConfig(
+        handlers=(QueueHandler(LOG_QUEUE),),
+        format='%(message)s',
+        level=logging.INFO
+    )
+    LOG_LISTENER.start()
+    atexit.register(LOG_LISTENER.stop)
 
 
 def time_test(func):
     """Функция декоратор, измеряет время выполнения функций."""
-    def f(*args):
-        t1 = time.time()
-        res = func(*args)
-        t2 = time.time()
-        result = round(int(t2 - t1) / 60, 1)
+    def f(*args, **kwargs):
+        t1 = time.perf_counter()
+        res = func(*args, **kwargs)
+        elapsed = time.perf_counter() - t1
+        METRICS.add_time(func.__name__, elapsed)
         logging.info(
-            'Время выполнения функции {}: {} минут'.format(
-                func.__name__, result)
+            'Время выполнения функции {}: {:.3f} с'.format(
+                func.__name__, elapsed)
         )
         return res
     return f
 
 
-def connect_to_database(local=True):
-    connection = psycopg2.connect(
-        dbname=os.environ.get(
-            'local_dbname' if local else 'dbname'
-        ),
-        user=os.environ.get(
-            'local_user' if local else 'user'
-        ),
-        password=os.environ.get(
-            'local_password' if local else 'password'
-        ),
-        host=os.environ.get(
-            'local_host' if local else 'host'
-        ),
-        port=os.environ.get(
-            'local_port' if local else 'port'
+def peak_memory():
+    """Пиковый объём памяти процесса в байтах, None - неизвестен."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class MemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD),
+                        ('PageFaultCount', wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    'PeakWorkingSetSize', 'WorkingSetSize',
+                    'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                    'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage',
+                    'PagefileUsage', 'PeakPagefileUsage')]
+
+        counters = MemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.windll.kernel32.GetCurrentProcess(),
+                ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except (ImportError, AttributeError, OSError):
+        pass
+    return None
+
+
+class Metrics:
+    """Время, число вызовов и обработанных единиц по этапам миграции.
+
+    Обработчики записей копят метрики в своей RowBatch, в общий набор
+    они попадают в transform(), в том числе из процессов-обработчиков.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.timers = {}  # этап -> [вызовов, секунд, единиц]
+        self.counters = {}
+        self.gauges = {}
+
+    def add_time(self, phase, seconds, items=0, calls=1):
+        with self.lock:
+            timer = self.timers.setdefault(phase, [0, 0.0, 0])
+            timer[0] += calls
+            timer[1] += seconds
+            timer[2] += items
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    @contextlib.contextmanager
+    def timer(self, phase, items=0):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - started, items)
+
+    def merge(self, batch):
+        """Добавляет метрики пачки обработчика и возвращает пачку.
+
+        Счётчики пачки сохраняются: по ним Progress считает итоги прогона.
+        """
+        for phase, (calls, seconds, items) in batch.timers.items():
+            self.add_time(phase, seconds, items, calls)
+        for name, value in batch.counters.items():
+            self.count(name, value)
+        return batch
+
+    def snapshot(self):
+        with self.lock:
+            phases = {
+                phase: {
+                    'calls': calls, 'seconds': round(seconds, 3),
+                    'items': items,
+                    'per_second': round(items / seconds, 1)
+                    if items and seconds else None,
+                }
+                for phase, (calls, seconds, items)
+                in sorted(self.timers.items())
+            }
+            counters = dict(sorted(self.counters.items()))
+            gauges = dict(sorted(self.gauges.items()))
+        return {
+            'package': PACKAGE, 'db_file': DB_FILE,
+            'elapsed_seconds': round(time.perf_counter() - self.started, 3),
+            'peak_memory_bytes': peak_memory(),
+            'phases': phases, 'counters': counters, 'gauges': gauges,
+        }
+
+
+METRICS = Metrics()
+
+
+def timed(phase, iterable):
+    """Отдаёт элементы iterable, считая время их получения этапом phase."""
+    iterator = iter(iterable)
+    seconds = 0.0
+    items = 0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - started
+            items += 1
+            yield item
+    finally:
+        METRICS.add_time(phase, seconds, items)
+
+
+def export_metrics():
+    """Сохраняет метрики миграции в JSON и текстовом формате Prometheus."""
+    snapshot = METRICS.snapshot()
+    for phase, timer in snapshot['phases'].items():
+        logging.info('Этап {}: {} вызовов, {:.3f} с{}'.format(
+            phase, timer['calls'], timer['seconds'],
+            ', {} ед., {:.0f} ед/с'.format(
+                timer['items'], timer['per_second'])
+            if timer['per_second'] else ''))
+    labels = 'package="{}",db_file="{}"'.format(PACKAGE, DB_FILE)
+    lines = [
+        '# TYPE migration_elapsed_seconds gauge',
+        'migration_elapsed_seconds{{{}}} {}'.format(
+            labels, snapshot['elapsed_seconds']),
+    ]
+    if snapshot['peak_memory_bytes'] is not None:
+        lines += [
+            '# TYPE migration_peak_memory_bytes gauge',
+            'migration_peak_memory_bytes{{{}}} {}'.format(
+                labels, snapshot['peak_memory_bytes']),
+        ]
+    for metric, key in (('migration_phase_seconds_total', 'seconds'),
+                        ('migration_phase_calls_total', 'calls'),
+                        ('migration_phase_items_total', 'items')):
+        lines.append('# TYPE {} counter'.format(metric))
+        lines += [
+            '{}{{{},phase="{}"}} {}'.format(metric, labels, phase, timer[key])
+            for phase, timer in snapshot['phases'].items()
+        ]
+    lines.append('# TYPE migration_events_total counter')
+    lines += [
+        'migration_events_total{{{},name="{}"}} {}'.format(
+            labels, name, value)
+        for name, value in snapshot['counters'].items()
+    ]
+    lines.append('# TYPE migration_gauge gauge')
+    lines += [
+        'migration_gauge{{{},name="{}"}} {}'.format(labels, name, value)
+        for name, value in snapshot['gauges'].items()
+    ]
+    path = '{}{}_{}'.format(
+        METRICS_DIRECTORY, PACKAGE,
+        datetime.datetime.now().strftime("%Y-%m-%d_%H-%M"))
+    try:
+        os.makedirs(METRICS_DIRECTORY, exist_ok=True)
+        with open(path + '.json', 'w', encoding='utf-8') as metrics_file:
+            json.dump(snapshot, metrics_file, indent=2)
+        with open(path + '.prom', 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write('\n'.join(lines) + '\n')
+    except OSError as ex:
+        logging.warning('Метрики не сохранены: {}'.format(ex))
+        return
+    logging.info('Метрики сохранены в {}.json и {}.prom'.format(path, path))
+
+
+class ConnectionPool:
+    """Пул соединений: ждёт свободное соединение и проверяет его связь.
+
+    Возвращённые соединения остаются открытыми (не больше POOL_MAX_SIZE),
+    поэтому при всплесках загрузки соединения не открываются заново.
+    """
+
+    def __init__(self, local):
+        self.name = 'pool_local' if local else 'pool_remote'
+        self.semaphore = threading.BoundedSemaphore(POOL_MAX_SIZE)
+        self.params = dict(
+            dbname=os.environ.get(
+                'local_dbname' if local else 'dbname'
+            ),
+            user=os.environ.get(
+                'local_user' if local else 'user'
+            ),
+            password=os.environ.get(
+                'local_password' if local else 'password'
+            ),
+            host=os.environ.get(
+                'local_host' if local else 'host'
+            ),
+            port=os.environ.get(
+                'local_port' if local else 'port'
+            )
         )
-    )
-    logging.info('Соединение установлено')
+        self.lock = threading.Lock()
+        self.idle = []
+        self.opened = 0
+        self.acquired = 0
+        self.broken = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.idle.extend(self.connect() for _ in range(POOL_MIN_SIZE))
+
+    def connect(self):
+        conn = psycopg2.connect(**self.params)
+        with self.lock:
+            self.opened += 1
+        METRICS.count(self.name + '_opened')
+        return conn
+
+    def is_alive(self, conn):
+        if conn.closed:
+            return False
+        if not POOL_HEALTH_CHECK:
+            return True
+        try:
+            conn.cursor().execute('SELECT 1')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def get(self):
+        started = time.perf_counter()
+        self.semaphore.acquire()
+        waited = time.perf_counter() - started
+        try:
+            while True:
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    conn = self.connect()
+                    break
+                if self.is_alive(conn):
+                    break
+                with self.lock:
+                    self.broken += 1
+                METRICS.count(self.name + '_broken')
+                conn.close()
+        except Exception:
+            self.semaphore.release()
+            raise
+        with self.lock:
+            self.acquired += 1
+            self.wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        METRICS.add_time(self.name + '_wait', waited)
+        return conn
+
+    def put(self, conn):
+        try:
+            if not conn.closed:
+                status = conn.info.transaction_status
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    conn.close()
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+        except psycopg2.Error:
+            conn.close()
+        if not conn.closed:
+            with self.lock:
+                self.idle.append(conn)
+        self.semaphore.release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+        METRICS.gauge(self.name + '_max_wait_seconds',
+                      round(self.max_wait, 3))
+        logging.info(
+            'Пул соединений: открыто {}, выдано {}, заменено {}, '
+            'ожидание {:.3f} с (максимум {:.3f} с)'.format(
+                self.opened, self.acquired, self.broken,
+                self.wait, self.max_wait)
+        )
+
+
+def connect_to_database(local=True):
+    with POOLS_LOCK:
+        connection_pool = POOLS.get(local)
+        if connection_pool is None:
+            connection_pool = POOLS[local] = ConnectionPool(local)
+            logging.info('Пул соединений создан')
+    connection = connection_pool.get()
+    CONNECTION_POOLS[id(connection)] = connection_pool
     cursor = connection.cursor()
     return connection, cursor
 
 
+def release_connection(connection):
+    """Возвращает соединение в пул вместо закрытия."""
+    CONNECTION_POOLS.pop(id(connection)).put(connection)
+
+
+def close_pools():
+    with POOLS_LOCK:
+        for connection_pool in POOLS.values():
+            connection_pool.close()
+        POOLS.clear()
+
+
+class RowBatch:
+    """Строки, подготовленные одним обработчиком записей."""
+
+    def __init__(self):
+        self.storage_objects = []
+        self.node_values = []
+        self.node_no_parent_values = []
+        self.attrs_values = []
+        self.superseded_root_objects = []
+        self.superseded_inner_objects = []
+        self.records = 0
+        self.completed = []  # NSER записей, обработанных без ошибок
+        self.images = []  # ожидающие конвертации картинки
+        self.date = None  # общее время создания строк текущей записи
+        self.timers = {}  # метрики обработчика, см. Metrics
+        self.counters = {}
+
+    def now(self):
+        return self.date or datetime.datetime.now()
+
+    def add_time(self, phase, seconds, items=0):
+        timer = self.timers.setdefault(phase, [0, 0.0, 0])
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] += items
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def extend(self, other):
+        self.storage_objects.extend(other.storage_objects)
+        self.node_values.extend(other.node_values)
+        self.node_no_parent_values.extend(other.node_no_parent_values)
+        self.attrs_values.extend(other.attrs_values)
+        self.superseded_root_objects.extend(other.superseded_root_objects)
+        self.superseded_inner_objects.extend(
+            other.superseded_inner_objects)
+        self.completed.extend(other.completed)
+        self.records += other.records
+
+
+class Progress:
+    """Периодически пишет в лог сводку хода обработки записей."""
+
+    def __init__(self, total=None):
+        self.total = total
+        self.records = 0
+        self.rows = {'Objects': 0, 'SearchAttributes': 0}
+        self.counts = {}  # records_<вид ОИС> -> записей этого прогона
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.reporter = threading.Thread(
+            target=self.run, name='Прогресс', daemon=True)
+
+    def add(self, batch):
+        with self.lock:
+            self.records += batch.records
+            self.rows['Objects'] += len(batch.storage_objects)
+            self.rows['SearchAttributes'] += (
+                len(batch.node_no_parent_values) + len(batch.node_values)
+                + len(batch.attrs_values)
+            )
+            for name, value in batch.counters.items():
+                if name.startswith('records_'):
+                    self.counts[name] = self.counts.get(name, 0) + value
+
+    def run(self):
+        while not self.stopped.wait(PROGRESS_INTERVAL):
+            self.report()
+
+    def report(self):
+        with self.lock:
+            records = self.records
+            rows = ', '.join(
+                '{} {}'.format(table, count)
+                for table, count in self.rows.items())
+        elapsed = time.monotonic() - self.started
+        rate = records / elapsed if elapsed else 0
+        if self.total and rate:
+            eta = datetime.timedelta(
+                seconds=int((self.total - records) / rate))
+        else:
+            eta = '-'
+        memory = peak_memory()
+        logging.info(
+            'Обработано записей %s%s, %.1f зап/с, строк: %s, осталось %s, '
+            'пик памяти %s',
+            records, '/{}'.format(self.total) if self.total else '',
+            rate, rows, eta,
+            '{:.0f} МБ'.format(memory / 1024 / 1024) if memory else '-'
+        )
+
+    def start(self):
+        self.reporter.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.reporter.join()
+        self.report()
+
+
+def current_batch():
+    batch = getattr(ROW_BATCH, 'batch', None)
+    if batch is None:
+        batch = ROW_BATCH.batch = RowBatch()
+    return batch
+
+
+def merge_batch(batch):
+    STORAGE_OBJECTS.extend(batch.storage_objects)
+    NODE_VALUES.extend(batch.node_values)
+    NODE_NO_PARENT_VALUES.extend(batch.node_no_parent_values)
+    ATTRS_VALUES.extend(batch.attrs_values)
+    SUPERSEDED_ROOT_OBJECTS.extend(batch.superseded_root_objects)
+    SUPERSEDED_INNER_OBJECTS.extend(batch.superseded_inner_objects)
+    COMPLETED_RECORDS.extend(batch.completed)
+
+
+def uuid7_batch(size):
+    """Пачка UUIDv7 по 16 байт, по убыванию для pop().
+
+    48 бит - время в мс, 12 бит - номер в пачке, чтобы идентификаторы
+    одной пачки шли по возрастанию, 62 бита - случайные.
+    """
+    prefix = (time.time_ns() // 1000000) << 80 | 0x7 << 76
+    randoms = os.urandom(8 * size)
+    return [
+        (prefix | i << 64 | 0x2 << 62
+         | int.from_bytes(randoms[8 * i:8 * i + 8], 'big') >> 2
+         ).to_bytes(16, 'big')
+        for i in range(size - 1, -1, -1)
+    ]
+
+
+def new_id_bytes():
+    """Новый идентификатор строки из запаса текущего потока, 16 байт.
+
+    Запас привязан к pid: дочерний процесс после fork не выдаст
+    идентификаторы, унаследованные от родителя.
+    """
+    if ID_FORMAT != 'uuid7':
+        return uuid.uuid1().bytes
+    ids = getattr(ID_BUFFER, 'ids', None)
+    if not ids or ID_BUFFER.pid != os.getpid():
+        ids = ID_BUFFER.ids = uuid7_batch(ID_BATCH_SIZE)
+        ID_BUFFER.pid = os.getpid()
+    return ids.pop()
+
+
+def format_id(raw):
+    """16 байт идентификатора -> строка вида 8-4-4-4-12."""
+    h = raw.hex()
+    return '{}-{}-{}-{}-{}'.format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def new_id():
+    return format_id(new_id_bytes())
+
+
 def create_storage_obj(kind, parent_number=None, retro_date=None, uid=None):
-    date = datetime.datetime.now()
-    storage_object_number = "{}".format(str(uuid.uuid1()) if not uid else uid)
-    STORAGE_OBJECTS.append(
-        [storage_object_number, kind,
+    batch = current_batch()
+    date = batch.now()
+    storage_object_number = uid if uid else new_id()
+    batch.storage_objects.append(
+        (storage_object_number, kind,
          parent_number if parent_number else '-ROOT-', STRUCTURE_ID,
          date, date, STATE, UNKNOWN_DATE, UNKNOWN_DATE,
-         PACKAGE, UNKNOWN_DATE, VERSION, retro_date]
+         PACKAGE, UNKNOWN_DATE, VERSION, retro_date)
         )
-    logging.info(
-        'Объект хранения {} успешно создан'.format(storage_object_number))
+    ROW_LOGGER.info('Объект хранения %s успешно создан', storage_object_number)
     return storage_object_number
 
 
 def create_node(parent_number, table_name, parent_attr_id=None, uid=None):
     kind = 5
-    date = datetime.datetime.now()
-    node_id = "{}".format(str(uuid.uuid1()) if not uid else uid)
+    batch = current_batch()
+    date = batch.now()
+    node_id = uid if uid else new_id()
     if parent_attr_id:
-        NODE_VALUES.append(
-            [node_id, table_name, parent_number,
+        batch.node_values.append(
+            (node_id, table_name, parent_number,
              parent_attr_id, kind, CREATED_BY,
-             date, node_id]
+             date, node_id)
         )
     else:
-        NODE_NO_PARENT_VALUES.append(
-            [node_id, table_name, parent_number,
-             kind, CREATED_BY, date, node_id]
-        )
-    logging.info(
-        'Узел таблицы {} - {} объекта {} успешно создан'.format(
-            table_name, node_id, parent_number)
+        batch.node_no_parent_values.append(
+            (node_id, table_name, parent_number,
+             kind, CREATED_BY, date, node_id)
         )
+    ROW_LOGGER.info(
+        'Узел таблицы %s - %s объекта %s успешно создан',
+        table_name, node_id, parent_number
+    )
     return node_id
 
 
+def attrs_plan(table_name):
+    """Возвращает заранее подготовленный план атрибутов таблицы."""
+    plan = ATTRS_PLANS.get(table_name)
+    if plan is None:
+        plan = ATTRS_PLANS[table_name] = tuple(
+            ATTRS_SCHEMA[table_name].items())
+    return plan
+
+
 def create_attrs(root_storage_obj_id, node_string_id=None,
                  record=None, table_name=None, parent_node_id=None,
                  main_table_id=None, mode=None):
-    date = datetime.datetime.now()
-    tables = {
-        'RUTrademark': {
-            'rutmk_uid': uuid.UUID(
-                node_string_id) if node_string_id else None,
-            'appl_doc_link': None,
-            'appl_ui_link': None,
-            'appl_type': None,
-            'appl_receiving_date': None,
-            'appl_number': 'NAP',
-            'appl_date': 'DAP',
-            'reg_ui_link': None,
-            'reg_doc_link': None,
-            'reg_number': 'NTM',
-            'reg_date': 'DPUB',
-            'reg_country': 'CU',
-            'reg_publ_number': None,
-            'reg_publ_date': None,
-            'status_code': 'SDACT',
-            'status_date': 'SDIZM',
-            'expiry_date': 'DEX',
-            'seniority_priority_number': None,
-            'seniority_priority_date': None,
-            'priority_date': 'DAPK',
-            'exhib_priority_date': 'DAPV',
-            'divisional_appl_number': 'NPARENT',
-            'divisional_appl_date': None,
-            'other_date': None,
-            'corr_address': 'MAIL2',
-            'corr_address_country': None,
-            'applicants': None,
-            'applicants_count': None,
-            'holders': 'OWN2',
-            'holders_count': None,
-            'representatives': 'NPP',
-            'representatives_count': None,
-            'representative_number': 'KPP',
-            'representatives_term': None,
-            'users': None,
-            'users_count': None,
-            'mark_category': None,
-            'representation_names': 'IMAGE_NAME',
-            'search_result': None,
-            'goods': 'GS',
-            'prev_reg_number': None,
-            'prev_reg_date': None,
-            'prev_reg_country': None,
-            'feature_description': None,
-            'disclaimers': None,
-            'association_marks': None,
-            'payment': None,
-            'records': None,
-            'corr_type': None,
-            'corr_method': None,
-            'sheets_count': None,
-            'image_sheets_count': None,
-            'payment_doc_count': None,
-            'is_external_search': None,
-            'outgoing_correspondence': None,
-            'responsible_expert': 'EXPRTNAME',
-            'retro_number': 'NSER',
-            'update_time': date,
-            'delete_time': None
-        },
-    }
-    wrong_values = ['TM_DAT__', 'NSER', 'NAP', 'NAPTW',
-                    'TWICE', 'DAP', 'CU', 'IS', 'WCD']
+    batch = current_batch()
+    date = batch.now()
+    node_uid = uuid.UUID(node_string_id) if node_string_id else None
+    attrs_values = batch.attrs_values
     try:
-        for attr, attr_value in tables[table_name].items():
-            value = record[
-                attr_value] if attr_value in record.keys() else attr_value
-            uid = uuid.uuid1()
-            attr_id = "{}".format(str(uid))
+        for attr, source in attrs_plan(table_name):
+            if source is None:
+                value = None
+            elif source is NODE_UID:
+                value = node_uid
+            elif source is UPDATE_TIME:
+                value = date
+            else:
+                value = record.get(source, source)
             data_type = type(value)
-            if data_type == str:
-                value.encode('ascii', errors='ignore').decode()
+            slot = VALUE_SLOTS.get(data_type)
+            if slot is None:  # float и bool не переносятся
+                continue
+            kind = slot[0]
+            if data_type is str:
                 if "'" in value:
-                    wrong_value = value.split("'")
-                    value = "`".join(wrong_value)
-                elif value == '' or value in wrong_values:
+                    value = value.replace("'", "`")
+                elif value == '' or value in WRONG_VALUES:
                     value = None
-                ATTRS_VALUES.append(
-                    [attr_id, date, root_storage_obj_id,
-                     node_string_id, attr,
-                     DATA_TYPES[data_type][0], value,
-                     None, None, None, CREATED_BY]
-                )
-            elif data_type == int:
-                ATTRS_VALUES.append(
-                    [attr_id, date, root_storage_obj_id,
-                     node_string_id, attr,
-                     DATA_TYPES[data_type][0], None,
-                     value, None, None, CREATED_BY]
-                )
-            elif data_type == NONETYPE:
-                ATTRS_VALUES.append(
-                    [attr_id, date, root_storage_obj_id,
-                     node_string_id, attr,
-                     DATA_TYPES[data_type][0], None,
-                     None, None, None, CREATED_BY]
-                )
-            elif data_type == datetime.date or data_type == datetime.datetime:
-                ATTRS_VALUES.append(
-                    [attr_id, date, root_storage_obj_id,
-                     node_string_id, attr,
-                     DATA_TYPES[data_type][0], None,
-                     None, value, None, CREATED_BY]
-                )
-            elif data_type == uuid.UUID:
+            elif data_type is uuid.UUID:
                 value = str(value)
-                ATTRS_VALUES.append(
-                    [attr_id, date, root_storage_obj_id,
-                     node_string_id, attr,
-                     DATA_TYPES[data_type][0], None,
-                     None, None, value, CREATED_BY]
-                )
+            attrs_values.append((new_id_bytes(), date, root_storage_obj_id,
+                                 node_string_id, attr, kind, value))
     except Exception as ex:
         exc_type, _, exc_tb = sys.exc_info()
         file_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         logging.error(
             ERROR_STRING.format(exc_type, file_name, exc_tb.tb_lineno, ex))
-    logging.info(
-        'Атрибуты таблицы {} - {} объекта {} успешно созданы'.format(
-            table_name, node_string_id, root_storage_obj_id))
+    ROW_LOGGER.info(
+        'Атрибуты таблицы %s - %s объекта %s успешно созданы',
+        table_name, node_string_id, root_storage_obj_id)
 
 
 @time_test
-def get_objects():
-    conn, cur = connect_to_database(local=False)
+def get_objects(parent_numbers):
+    objects = {}
+    if not parent_numbers:
+        return objects
+    conn, _ = connect_to_database(local=False)
+    cur = conn.cursor(name='migration_objects')
+    cur.itersize = PREFETCH_ITERSIZE
     query = """
-        SELECT * FROM "Objects"
+        SELECT "ParentNumber", "Number" FROM "Objects"
         WHERE "ClassType" BETWEEN '100' AND '800'
+        AND "ParentNumber" = ANY(%s)
     """
-    cur.execute(query)
-    objects = cur.fetchall()
-    conn.close()
+    try:
+        cur.execute(query, (parent_numbers,))
+        for parent_number, number in cur:
+            objects.setdefault(parent_number, number)
+    finally:
+        cur.close()
+        release_connection(conn)
     return objects
 
 
-OBJECTS = get_objects()
-
-
 @time_test
-def get_attrs():
-    conn, cur = connect_to_database(local=False)
+def get_attrs(nsers, ntms):
+    attrs_by_retro_number = {}
+    attrs_by_appl_number = {}
+    conn, _ = connect_to_database(local=False)
+    cur = conn.cursor(name='migration_attrs')
+    cur.itersize = PREFETCH_ITERSIZE
     query = """
-        SELECT * FROM "SearchAttributes"
-        WHERE "CreatedBy" LIKE 'EA_Migration_%'
+        SELECT "IntValue", "TextValue", "ParentNumber", "ParentAttrId"
+        FROM "SearchAttributes"
+        WHERE "CreatedBy" LIKE 'EA_Migration_%%'
         AND "Name" IN ('retro_number', 'appl_number')
+        AND ("IntValue" = ANY(%s) OR "TextValue" = ANY(%s))
     """
-    cur.execute(query)
-    attrs = cur.fetchall()
-    conn.close()
-    return attrs
+    try:
+        cur.execute(query, (nsers, ntms))
+        for int_value, text_value, parent_number, parent_attr_id in cur:
+            row = (parent_number, parent_attr_id)
+            if int_value is not None:
+                attrs_by_retro_number.setdefault(int_value, row)
+            if text_value is not None:
+                attrs_by_appl_number.setdefault(text_value, row)
+    finally:
+        cur.close()
+        release_connection(conn)
+    return attrs_by_retro_number, attrs_by_appl_number
 
 
-ATTRS = get_attrs()
+def prefetch(collected_data_dict):
+    """Загружает ранее перенесённые записи только для ключей пакета."""
+    nsers = list(collected_data_dict)
+    ntms = list({
+        record['NTM'][:-2] + '00'
+        for record in collected_data_dict.values() if record.get('NTM')
+    })
+    with METRICS.timer('prefetch', len(nsers)):
+        attrs_by_retro_number, attrs_by_appl_number = get_attrs(nsers, ntms)
+        objects_by_parent = get_objects(
+            list({row[0] for row in attrs_by_retro_number.values()})
+        )
+    # карты прошлой пачки больше не нужны, иначе они растут весь прогон
+    ATTRS_BY_RETRO_NUMBER.clear()
+    ATTRS_BY_RETRO_NUMBER.update(attrs_by_retro_number)
+    ATTRS_BY_APPL_NUMBER.clear()
+    ATTRS_BY_APPL_NUMBER.update(attrs_by_appl_number)
+    OBJECTS_BY_PARENT.clear()
+    OBJECTS_BY_PARENT.update(objects_by_parent)
+    return attrs_by_retro_number, attrs_by_appl_number, objects_by_parent
 
 
-def delete_storage_objects(storage_objects_id):
-    conn, cur = connect_to_database(local=False)
+def delete_storage_objects(cur, storage_objects_ids):
     query = """
         DELETE FROM "Objects"
-        WHERE "Number" = '{}'
-    """.format(storage_objects_id)
-    cur.execute(query)
-    conn.commit()
-    conn.close()
+        WHERE "Number" = ANY(%s)
+    """
+    logging.info('Удаление {} объектов хранения'.format(
+        len(storage_objects_ids)))
+    with METRICS.timer('delete', len(storage_objects_ids)):
+        for start in range(0, len(storage_objects_ids), DELETE_BATCH_SIZE):
+            cur.execute(
+                query,
+                (storage_objects_ids[start:start + DELETE_BATCH_SIZE],))
 
 
 def delete_image(file_path, storage_object_id):
@@ -391,32 +1068,119 @@ def create_contact(root_storage_obj_id, parent_table_id,
         root_storage_obj_id, ContactType_id, record,
         table_name, parent_table_id, Contact_id, mode=mode
     )
-    logging.info(
-        'Контакт типа {} таблицы {} - {} объекта {} успешно создан'.format(
-            mode, table_name, parent_table_id, root_storage_obj_id)
+    ROW_LOGGER.info(
+        'Контакт типа %s таблицы %s - %s объекта %s успешно создан',
+        mode, table_name, parent_table_id, root_storage_obj_id
     )
 
 
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def image_cache_key(image_path):
+    """Ключ кэша: содержимое исходника и параметры конвертации."""
+    return '{}_RGB_q{}'.format(file_digest(image_path), JPEG_QUALITY)
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def get_cached_image(cache_key, destination):
+    """Кладёт в destination JPEG из кэша и возвращает его размеры."""
+    cached = os.path.join(IMAGE_CACHE_DIRECTORY, cache_key)
+    try:
+        with open(cached + '.json', encoding='utf-8') as meta_file:
+            size = json.load(meta_file)
+        link_or_copy(cached + '.jpg', destination)
+        os.utime(cached + '.json')  # время последнего использования
+    except (OSError, ValueError):
+        return None
+    return size
+
+
+def put_cached_image(cache_key, converted, size):
+    os.makedirs(IMAGE_CACHE_DIRECTORY, exist_ok=True)
+    cached = os.path.join(IMAGE_CACHE_DIRECTORY, cache_key)
+    temp = '{}.{}.tmp'.format(cached, uuid.uuid4().hex)
+    link_or_copy(converted, temp)
+    os.replace(temp, cached + '.jpg')
+    with open(temp, 'w', encoding='utf-8') as meta_file:
+        json.dump(size, meta_file)
+    os.replace(temp, cached + '.json')
+
+
+def evict_image_cache():
+    """Удаляет давно не использованные картинки сверх IMAGE_CACHE_SIZE.
+
+    Заодно удаляет файлы без пары .jpg/.json и недописанные .tmp,
+    если они старше IMAGE_CACHE_ORPHAN_AGE.
+    """
+    if not IMAGE_CACHE or not os.path.isdir(IMAGE_CACHE_DIRECTORY):
+        return
+    files = {}
+    with os.scandir(IMAGE_CACHE_DIRECTORY) as cache_dir:
+        for entry in cache_dir:
+            if entry.is_file():
+                files[entry.name] = entry.stat()
+    orphan_time = time.time() - IMAGE_CACHE_ORPHAN_AGE
+    entries = []
+    total = 0
+    orphans = 0
+    for name, stat in files.items():
+        cached, suffix = os.path.splitext(name)
+        pair = {'.json': '.jpg', '.jpg': '.json'}.get(suffix)
+        if pair and cached + pair in files:
+            if suffix == '.json':
+                size = files[cached + '.jpg'].st_size
+                entries.append((stat.st_mtime,
+                                os.path.join(IMAGE_CACHE_DIRECTORY, cached),
+                                size))
+                total += size
+            continue
+        if stat.st_mtime < orphan_time:
+            try:
+                os.remove(os.path.join(IMAGE_CACHE_DIRECTORY, name))
+                orphans += 1
+            except OSError:
+                pass
+    entries.sort()
+    removed = 0
+    for _, cached, size in entries:
+        if total <= IMAGE_CACHE_SIZE:
+            break
+        for suffix in ('.json', '.jpg'):
+            try:
+                os.remove(cached + suffix)
+            except OSError:
+                pass
+        total -= size
+        removed += 1
+    logging.info(
+        'Кэш картинок: %s МБ, удалено %s картинок и %s лишних файлов',
+        total // (1024 * 1024), removed, orphans)
+
+
 def import_image(image_path, date, root_storage_obj_id,
-                 storage_obj_id, nser, image_name, image_type,
-                 convert=False):
+                 storage_obj_id, image_name, image_type):
+    """Копирует исходную картинку и сохраняет её JPEG-версию.
+
+    Исходный файл декодируется один раз, размеры берутся из заголовка,
+    оба файла сразу пишутся под итоговыми именами. JPEG-исходник
+    только копируется и даёт один файл.
+    """
     try:
         extensions = {'TIFF': 'TIF',
                       'JPEG': 'JPG'}
-        if convert:
-            image = Image.open(image_path).convert('RGB')
-            image_path = '.'.join(
-                [image_path.split(".")[0], extensions[image_type]]
-            )
-            image.save(image_path, 'JPEG', quality=80)
-            image.close()
-        image = Image.open(image_path)
-        height, width = image.size
-        image.close()
         file_id = uuid.UUID(storage_obj_id)
-        new_filename = '{}_1_{}.{}'.format(
-            file_id.hex, image_name, extensions[image_type]
-        )
         folders = [
             '{}'.format(date.strftime("%Y")),
             '{}'.format(date.strftime("%m")),
@@ -428,39 +1192,151 @@ def import_image(image_path, date, root_storage_obj_id,
         path = '{}img_data\\'.format(DESTINATION) + "\\".join(folders)
         final_path = NFS + '/'.join(folders) + '/'
         os.makedirs(path, exist_ok=True)
-        os.system('cp {} {}'.format(image_path, path))
-        os.system(
-            f'ren {path}\\{image_name}.{extensions[image_type]} {new_filename}'
+        file_types = (image_type,) if image_type == 'JPEG' \
+            else (image_type, 'JPEG')
+        filenames = [
+            '{}_1_{}.{}'.format(file_id.hex, image_name, extensions[file_type])
+            for file_type in file_types
+        ]
+        paths = [
+            '{}\\{}'.format(path, new_filename) for new_filename in filenames
+        ]
+        source_copy, converted = paths[0], paths[-1]
+        started = time.perf_counter()
+        if os.path.exists(source_copy):
+            # может быть жёсткой ссылкой на файл кэша
+            os.remove(source_copy)
+        shutil.copyfile(image_path, source_copy)
+        copied = time.perf_counter()
+        size = None
+        if converted == source_copy:
+            with Image.open(image_path) as image:
+                height, width = image.size
+        else:
+            if os.path.exists(converted):
+                os.remove(converted)
+            cache_key = image_cache_key(image_path) if IMAGE_CACHE else None
+            size = get_cached_image(cache_key, converted) \
+                if cache_key else None
+            if size:
+                height, width = size
+            else:
+                with Image.open(image_path) as image:
+                    height, width = image.size
+                    image.convert('RGB').save(
+                        converted, 'JPEG', quality=JPEG_QUALITY)
+                if cache_key:
+                    put_cached_image(cache_key, converted, (height, width))
+        finished = time.perf_counter()
+        ROW_LOGGER.info(
+            'Картинка %s: копирование %.3f с, конвертация %.3f с%s',
+            image_name, copied - started, finished - copied,
+            ' (из кэша)' if size else ''
         )
-        logging.info('Файл {}{} создан'.format(final_path, new_filename))
-        keys = ['file_path', 'file_name', 'file_type',
-                'content', 'height', 'width']
-        values = [final_path + new_filename, new_filename,
-                  image_type, file_id, height, width]
-        file_data = dict(zip(keys, values))
+        files = []
+        for file_type, new_filename in zip(file_types, filenames):
+            ROW_LOGGER.info('Файл %s%s создан', final_path, new_filename)
+            keys = ['file_path', 'file_name', 'file_type',
+                    'content', 'height', 'width']
+            values = [final_path + new_filename, new_filename,
+                      file_type, file_id, height, width]
+            files.append(dict(zip(keys, values)))
     except Exception as ex:
         exc_type, _, exc_tb = sys.exc_info()
         file_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         logging.error(
             ERROR_STRING.format(exc_type, file_name, exc_tb.tb_lineno, ex)
         )
-    return file_data
+        raise
+    return files
 
 
-@time_test
-def execute_query_list(query, values_list):
-    conn, cur = connect_to_database(local=False)
-    conn.set_session(autocommit=True)
+def execute_query_list(conn, query, values_list, row_format=None):
+    cur = conn.cursor()
     logging.info('Загрузка {} строк'.format(len(values_list)))
-    extras.execute_batch(cur, query, values_list, 2000)
-    conn.close()
+    if row_format:
+        values_list = map(row_format, values_list)
+    extras.execute_batch(cur, query, values_list, BATCH_PAGE_SIZE)
+
+
+def attrs_row(row):
+    """Компактная строка атрибута -> строка ATTRS_QUERY/ATTRS_COPY."""
+    raw_id, date, root_storage_obj_id, node_string_id, attr, kind, value = row
+    wire = [format_id(raw_id), date, root_storage_obj_id, node_string_id,
+            attr, kind, None, None, None, None, CREATED_BY]
+    if value is not None:
+        wire[KIND_COLUMNS[kind]] = value
+    return wire
+
+
+def copy_value(value):
+    """Преобразует значение в поле текстового формата COPY."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value).translate(COPY_ESCAPES)
+
+
+class CopyStream:
+    """Файлоподобный объект, отдающий строки COPY по мере чтения."""
+
+    def __init__(self, values_list, row_format=None):
+        if row_format:
+            values_list = map(row_format, values_list)
+        self.lines = (
+            '\t'.join(map(copy_value, row)) + '\n' for row in values_list
+        )
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line.encode('utf-8')
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    readline = read
+
+
+def copy_query_list(conn, query, values_list, row_format=None):
+    cur = conn.cursor()
+    logging.info('Загрузка {} строк через COPY'.format(len(values_list)))
+    chunk_size = COPY_CHUNK_SIZE or len(values_list) or 1
+    for start in range(0, len(values_list), chunk_size):
+        cur.copy_expert(
+            query,
+            CopyStream(values_list[start:start + chunk_size], row_format)
+        )
+
+
+def load_query_list(conn, query, copy_query, values_list, row_format=None,
+                    table='rows'):
+    # время загрузки учитывается только здесь, этапом load_<таблица>
+    started = time.perf_counter()
+    with METRICS.timer('load_' + table, len(values_list)):
+        if LOAD_METHOD == 'copy':
+            copy_query_list(conn, copy_query, values_list, row_format)
+        else:
+            execute_query_list(conn, query, values_list, row_format)
+    logging.info('Время загрузки {}: {:.3f} с'.format(
+        table, time.perf_counter() - started))
 
 
 def appellation_number_check(ntm_number):
-    for row in ATTRS:
-        if ntm_number == row[4]:
-            parent_attr_id = row[12]
-            return parent_attr_id
+    row = ATTRS_BY_APPL_NUMBER.get(ntm_number)
+    if row:
+        parent_attr_id = row[1]
+        return parent_attr_id
     return
 
 
@@ -468,7 +1344,6 @@ def create_main_tables(record, kind, table_prefix,
                        old_root_obj_id=None, table_id=None,
                        inner_obj_id=None,
                        rewrite=False):
-    nser = record.get('NSER')
     retro_date = record.get('DAP')
     image_name = record.get('IMAGE_NAME')
     image_path = record.get('IMAGE_PATH')
@@ -572,72 +1447,97 @@ def create_main_tables(record, kind, table_prefix,
         create_contact(root_obj_id, root_table_id, mode,
                        record, table_prefix + 'Representative')
     if image_path:
-        convert = False  # делаем TIF и JPEG
         if rewrite:
             old_uid = inner_obj_id if inner_obj_id else None
         storage_object_id = create_storage_obj(
             kind, root_obj_id, retro_date, old_uid if rewrite else None)
-        for _ in range(2):
-            WKTrademarkRepresentationFile_id = create_node(
-                storage_object_id, modes[table_prefix][1], root_table_id
-            )
-            file_data = import_image(
-                image_path, date, root_obj_id, storage_object_id,
-                nser, image_name, image_type, convert
-            )
-            create_attrs(
-                storage_object_id, WKTrademarkRepresentationFile_id,
-                file_data, modes[table_prefix][1], root_table_id
+        image_job = (image_path, date, root_obj_id, storage_object_id,
+                     image_name, image_type)
+        if IMAGE_EXECUTOR:
+            current_batch().images.append((
+                record['NSER'], storage_object_id, modes[table_prefix][1],
+                root_table_id,
+                IMAGE_EXECUTOR.submit(timed_import_image, *image_job)
+            ))
+        else:
+            files, seconds = timed_import_image(*image_job)
+            current_batch().add_time('image_conversion', seconds, 1)
+            create_image_tables(
+                storage_object_id, modes[table_prefix][1], root_table_id,
+                files
             )
-            convert = True
-            image_type = 'JPEG'
+
+
+def timed_import_image(*image_job):
+    """import_image и время его работы, в том числе в процессе пула."""
+    started = time.perf_counter()
+    files = import_image(*image_job)
+    return files, time.perf_counter() - started
+
+
+def create_image_tables(storage_object_id, table_name, root_table_id, files):
+    for file_data in files:  # TIF и JPEG
+        WKTrademarkRepresentationFile_id = create_node(
+            storage_object_id, table_name, root_table_id
+        )
+        create_attrs(
+            storage_object_id, WKTrademarkRepresentationFile_id,
+            file_data, table_name, root_table_id
+        )
+
+
+def attach_images():
+    """Дожидается картинок пачки и создаёт для них узлы и атрибуты."""
+    batch = current_batch()
+    for nser, storage_object_id, table_name, root_table_id, job \
+            in batch.images:
+        try:
+            files, seconds = job.result()
+        except Exception:
+            # ошибка уже записана в лог процессом конвертации
+            if nser in batch.completed:
+                batch.completed.remove(nser)
+            continue
+        batch.add_time('image_conversion', seconds, 1)
+        create_image_tables(
+            storage_object_id, table_name, root_table_id, files)
+    batch.images = []
 
 
 def thread(record):
     try:
         nser = record.get('NSER')
         rewrite = False
-        for row in ATTRS:
-            if nser == row[5]:
-                old_root_obj_id = row[1]
-                table_id = row[12]
-                inner_obj_id = None
-                for row in OBJECTS:
-                    if old_root_obj_id == row[6]:
-                        inner_obj_id = row[0]
-                        delete_storage_objects(inner_obj_id)
-                        break
-                delete_storage_objects(old_root_obj_id)
-                rewrite = True
-                break
+        row = ATTRS_BY_RETRO_NUMBER.get(nser)
+        if row:
+            old_root_obj_id, table_id = row
+            inner_obj_id = OBJECTS_BY_PARENT.get(old_root_obj_id)
+            if inner_obj_id:
+                current_batch().superseded_inner_objects.append(
+                    inner_obj_id)
+            current_batch().superseded_root_objects.append(old_root_obj_id)
+            rewrite = True
         ntm = record.get('NTM')
         if ntm[:3] == '999':  # WKTrademark
-            global WK_COUNT
-            WK_COUNT += 1
             kind = 100010
             record['NTM'] = ntm[3:]
             table_prefix = 'WKTmk'
         elif record['IS'] == 'I':  # Madrid
-            global MDRD_COUNT
-            MDRD_COUNT += 1
             kind = 100001
             table_prefix = 'MadridTmk'
         elif record.get('WCD') == 'N':
             kind = 100002
             if ntm[-2:] == '00':  # RUAppellation
-                global APL_COUNT
-                APL_COUNT += 1
                 table_prefix = 'RUApl'
             else:  # RuAppellationCertificate
-                global APLCERT_COUNT
-                APLCERT_COUNT += 1
                 table_prefix = 'RUAplCert'
                 logging.warning('ПНМПТ: {}'.format(nser))
         else:  # RUTrademark
-            global TMK_COUNT
-            TMK_COUNT += 1
             kind = 100001
             table_prefix = 'RUTmk'
+        # счётчик пачки обработчика, без общих глобальных переменных
+        current_batch().count('records_' + table_prefix)
+        started = time.perf_counter()
         create_main_tables(
             record, kind, table_prefix,
             old_root_obj_id if rewrite else None,
@@ -645,7 +1545,10 @@ def thread(record):
             inner_obj_id if rewrite else None,
             rewrite
         )
-        logging.info('Обработка серийного номера {} завершена'.format(nser))
+        current_batch().add_time(
+            'transform_' + table_prefix, time.perf_counter() - started, 1)
+        current_batch().completed.append(nser)
+        ROW_LOGGER.info('Обработка серийного номера %s завершена', nser)
     except Exception as ex:
         exc_type, _, exc_tb = sys.exc_info()
         file_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -655,22 +1558,152 @@ def thread(record):
     return
 
 
+def update_counts(counters):
+    """Переносит итоги пачек прогона в счётчики ОИС и пишет сводку.
+
+    counters - счётчики records_<вид ОИС>, собранные Progress из пачек.
+    """
+    global TMK_COUNT, WK_COUNT, MDRD_COUNT, APL_COUNT, APLCERT_COUNT
+    TMK_COUNT = counters.get('records_RUTmk', 0)
+    WK_COUNT = counters.get('records_WKTmk', 0)
+    MDRD_COUNT = counters.get('records_MadridTmk', 0)
+    APL_COUNT = counters.get('records_RUApl', 0)
+    APLCERT_COUNT = counters.get('records_RUAplCert', 0)
+    logging.info(
+        'Обработано ОИС: товарных знаков {}, общеизвестных {}, '
+        'мадридских {}, НМПТ {}, свидетельств НМПТ {}'.format(
+            TMK_COUNT, WK_COUNT, MDRD_COUNT, APL_COUNT, APLCERT_COUNT))
+
+
+def init_logging(log_queue):
+    """Направляет лог процесса-обработчика в общий лог."""
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+
+
+def worker_log_queue():
+    global WORKER_LOG_QUEUE, WORKER_LOG_LISTENER
+    if WORKER_LOG_LISTENER is None:
+        WORKER_LOG_QUEUE = multiprocessing.Queue()
+        # записи обработчиков идут в лог основного процесса,
+        # файл пишет только LOG_LISTENER
+        WORKER_LOG_LISTENER = QueueListener(
+            WORKER_LOG_QUEUE, *logging.getLogger().handlers)
+        WORKER_LOG_LISTENER.start()
+    return WORKER_LOG_QUEUE
+
+
+def init_worker(attrs_by_retro_number, attrs_by_appl_number,
+                objects_by_parent, log_queue=None):
+    """Передаёт процессу-обработчику ранее перенесённые записи.
+
+    Карты заменяются целиком, чтобы не копить записи прошлых пачек.
+    """
+    global WORKER_PROCESS
+    WORKER_PROCESS = True
+    if log_queue is not None:
+        init_logging(log_queue)
+    for target, source in ((ATTRS_BY_RETRO_NUMBER, attrs_by_retro_number),
+                           (ATTRS_BY_APPL_NUMBER, attrs_by_appl_number),
+                           (OBJECTS_BY_PARENT, objects_by_parent)):
+        if target is source:
+            # при fork initargs - те же словари, что и в основном процессе
+            continue
+        target.clear()
+        target.update(source)
+
+
+def process_records(records, known=None):
+    """Обрабатывает пачку записей и возвращает подготовленные строки."""
+    if known and WORKER_PROCESS:
+        # в потоках карты уже заполнены prefetch() основного процесса
+        init_worker(*known)
+    ROW_BATCH.batch = RowBatch()
+    for record in records:
+        ROW_BATCH.batch.date = datetime.datetime.now()
+        thread(record)
+    attach_images()
+    batch = ROW_BATCH.batch
+    batch.records = len(records)
+    ROW_BATCH.batch = None
+    return batch
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def create_executor():
+    global IMAGE_EXECUTOR
+    if EXECUTOR_MODE == 'process':
+        # картинки конвертируются в самих процессах-обработчиках
+        return ProcessPoolExecutor(
+            WORKERS, initializer=init_worker,
+            initargs=(ATTRS_BY_RETRO_NUMBER, ATTRS_BY_APPL_NUMBER,
+                      OBJECTS_BY_PARENT, worker_log_queue())
+        )
+    if IMAGE_MODE == 'pool':
+        IMAGE_EXECUTOR = ProcessPoolExecutor(
+            IMAGE_WORKERS, initializer=init_logging,
+            initargs=(worker_log_queue(),)
+        )
+    if EXECUTOR_MODE == 'thread':
+        return ThreadPoolExecutor(WORKERS, thread_name_prefix='Обработка')
+    return None
+
+
+def shutdown_executor(executor):
+    global IMAGE_EXECUTOR, WORKER_LOG_LISTENER
+    if executor:
+        executor.shutdown()
+    if IMAGE_EXECUTOR:
+        IMAGE_EXECUTOR.shutdown()
+        IMAGE_EXECUTOR = None
+    if WORKER_LOG_LISTENER:
+        WORKER_LOG_LISTENER.stop()
+        WORKER_LOG_LISTENER = None
+
+
+def transform(records, executor, known=None):
+    """Отдаёт подготовленные строки по пачкам в порядке записей."""
+    # Пачки - последовательные диапазоны записей, отдаются по порядку,
+    # поэтому строки совпадают с последовательной обработкой
+    ranges = chunked(records, RECORDS_CHUNK_SIZE)
+    if executor is None:
+        for chunk in ranges:
+            yield METRICS.merge(process_records(chunk))
+        return
+    pending = deque()
+    for chunk in ranges:
+        if len(pending) >= WORKERS * 2:
+            yield METRICS.merge(pending.popleft().result())
+        pending.append(executor.submit(process_records, chunk, known))
+    while pending:
+        yield METRICS.merge(pending.popleft().result())
+
+
 @time_test
 def import_data(big_dict):
     try:
-        threads = []
-        for nser in big_dict:
-            t = threading.Thread(
-                target=thread,
-                name='Обработка серийного номера {}'.format(nser),
-                args=[big_dict[nser]]
-            )
-            threads.append(t)
-            t.start()
-            logging.info('{} стартовала'.format(t.name))
-        logging.info('Ждём завершения всех потоков')
-        for t in threads:
-            t.join()
+        logging.info('Обработка {} записей, {} обработчиков ({})'.format(
+            len(big_dict), WORKERS, EXECUTOR_MODE))
+        executor = create_executor()
+        progress = Progress(len(big_dict))
+        progress.start()
+        try:
+            records = (big_dict[nser] for nser in sorted(big_dict))
+            for batch in transform(records, executor):
+                merge_batch(batch)
+                progress.add(batch)
+        finally:
+            shutdown_executor(executor)
+            progress.stop()
+            update_counts(progress.counts)
     except Exception as ex:
         exc_type, _, exc_tb = sys.exc_info()
         file_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -679,43 +1712,307 @@ def import_data(big_dict):
         )
 
 
+class DBFReader:
+    """Читает из DBF только нужные поля записей из диапазона NSER."""
+
+    def __init__(self, path, fields=None, **kwargs):
+        self.path = path
+        self.table = DBF(path, **kwargs)
+        self.headerlen = self.table.header.headerlen
+        self.recordlen = self.table.header.recordlen
+        self.numrecords = self.table.header.numrecords
+        layout = {}
+        offset = 1  # первый байт записи - признак удаления
+        for field in self.table.fields:
+            layout[field.name] = (field, offset, offset + field.length)
+            offset += field.length
+        self.nser = layout['NSER']
+        self.fields = [
+            (name,) + layout[name] for name in (fields or layout)
+            if name in layout
+        ]
+
+    def scan(self, parse, infile):
+        """Отдаёт (номер записи, NSER, данные), не разбирая прочие поля."""
+        field, begin, end = self.nser
+        infile.seek(self.headerlen)
+        for index in range(self.numrecords):
+            data = infile.read(self.recordlen)
+            if data[:1] != b' ':  # удалённая запись или конец файла
+                if data[:1] in (b'\x1a', b''):
+                    break
+                continue
+            yield index, parse(field, data[begin:end]), data
+
+    def seek(self, infile, positions):
+        for index in positions:
+            infile.seek(self.headerlen + index * self.recordlen)
+            data = infile.read(self.recordlen)
+            if data[:1] == b' ':
+                yield index, None, data
+
+    def open_memofile(self):
+        table = self.table
+        if table.memofilename and not table.raw:
+            return open_memofile(table.memofilename, table.header.dbversion)
+        return FakeMemoFile(table.memofilename)
+
+    def records(self, start, end, positions=None):
+        """Отдаёт записи с start <= NSER < end.
+
+        Если переданы номера записей из индекса, читаются только они,
+        иначе файл просматривается целиком.
+        """
+        with open(self.path, 'rb') as infile, \
+                self.open_memofile() as memofile:
+            parse = self.table.parserclass(self.table, memofile).parse
+            if positions is None:
+                rows = self.scan(parse, infile)
+            else:
+                rows = self.seek(infile, positions)
+            nser_field, nser_begin, nser_end = self.nser
+            for _, nser, data in rows:
+                if nser is None:
+                    nser = parse(nser_field, data[nser_begin:nser_end])
+                if nser is None or not start <= nser < end:
+                    continue
+                yield {
+                    name: parse(field, data[begin:stop])
+                    for name, field, begin, stop in self.fields
+                }
+
+    def index(self):
+        """Пара массивов (NSER, номер записи), упорядоченная по NSER.
+
+        Размер индекса зависит только от числа записей, а не от значений
+        NSER. Записи с одинаковым NSER идут в порядке файла. Индекс
+        сохраняется рядом с DBF и перестраивается, если файл изменился.
+        """
+        stat = os.stat(self.path)
+        stamp = array('q', [DBF_INDEX_VERSION, stat.st_size,
+                            stat.st_mtime_ns])
+        index_path = self.path + DBF_INDEX_SUFFIX
+        if os.path.isfile(index_path):
+            saved = array('q')
+            with open(index_path, 'rb') as index_file:
+                saved.frombytes(index_file.read())
+            if saved[:3] == stamp and len(saved) == 4 + 2 * saved[3]:
+                count = saved[3]
+                return saved[4:4 + count], saved[4 + count:]
+        nsers = array('q')
+        positions = array('q')
+        with open(self.path, 'rb') as infile:
+            parse = self.table.parserclass(self.table).parse
+            for index, nser, _ in self.scan(parse, infile):
+                if nser is None:
+                    continue
+                nsers.append(int(nser))
+                positions.append(index)
+        if any(nsers[i] > nsers[i + 1] for i in range(len(nsers) - 1)):
+            order = sorted(range(len(nsers)), key=nsers.__getitem__)
+            nsers = array('q', (nsers[i] for i in order))
+            positions = array('q', (positions[i] for i in order))
+        try:
+            with open(index_path, 'wb') as index_file:
+                index_file.write(
+                    (stamp + array('q', [len(nsers)]) + nsers + positions)
+                    .tobytes())
+        except OSError as ex:
+            logging.warning('Индекс {} не сохранён: {}'.format(index_path, ex))
+        return nsers, positions
+
+    @staticmethod
+    def lookup(index, start, end, nsers=None):
+        """Номера записей с start <= NSER < end, при nsers - только их."""
+        keys, positions = index
+        low = bisect.bisect_left(keys, start)
+        high = bisect.bisect_left(keys, end, low)
+        if nsers is None:
+            return positions[low:high]
+        return (
+            positions[i] for i in range(low, high) if keys[i] in nsers
+        )
+
+
+def mains_fields():
+    fields = set(RECORD_FIELDS)
+    for schema in ATTRS_SCHEMA.values():
+        fields.update(
+            source for source in schema.values() if isinstance(source, str))
+    return fields
+
+
+def read_mains(directory, start, end):
+    """Читает записи MD_MAINS.DBF, по индексу - сразу в порядке NSER."""
+    reader = DBFReader(
+        os.path.join(directory, "MD_MAINS.DBF"), mains_fields(),
+        ignore_missing_memofile=True
+    )
+    positions = None
+    if DBF_INDEX:
+        with METRICS.timer('dbf_index'):
+            index = reader.index()
+        positions = reader.lookup(index, start, end)
+    return timed('dbf_read', reader.records(start, end, positions))
+
+
+def goods_readers(directory):
+    goods_name_template = 'MD_GOOD{}.DBF'
+    readers = []
+    for num in range(9):
+        dbf_name = goods_name_template.format(
+            "S" if num == 0 else str(num)
+        )
+        dbf_path = os.path.join(
+            directory, dbf_name)
+        if os.path.isfile(dbf_path):
+            readers.append(DBFReader(dbf_path, ('NSER', 'GOODS')))
+    return readers
+
+
+def read_goods(directory, start, end):
+    goods = {}
+    started = time.perf_counter()
+    for reader in goods_readers(directory):
+        for r in reader.records(start, end):
+            goods[r['NSER']] = r['GOODS']
+    METRICS.add_time('goods', time.perf_counter() - started, len(goods))
+    return goods
+
+
+def read_chunk_goods(readers, nsers):
+    """Товары только для записей nsers; readers - пары (DBFReader, индекс)."""
+    goods = {}
+    if not nsers:
+        return goods
+    started = time.perf_counter()
+    start, end = min(nsers), max(nsers) + 1
+    wanted = set(nsers)
+    for reader, index in readers:
+        positions = None
+        if index is not None:
+            positions = reader.lookup(index, start, end, wanted)
+        for r in reader.records(start, end, positions):
+            goods[r['NSER']] = r['GOODS']
+    METRICS.add_time('goods', time.perf_counter() - started, len(goods))
+    return goods
+
+
+def scan_image_dir(path, cache):
+    """Читает один каталог картинок, если он изменился с прошлого запуска."""
+    mtime = os.stat(path).st_mtime_ns
+    entry = cache.get(path)
+    if entry is not None and entry['mtime'] == mtime:
+        return entry
+    images = []
+    dirs = []
+    with os.scandir(path) as files:
+        for file in files:
+            if file.is_dir():
+                dirs.append(file.path)
+                continue
+            name, ext = os.path.splitext(file.name)
+            image_type = IMAGE_TYPES.get(ext[1:].upper())
+            if image_type and name.isdigit():
+                images.append([int(name), name, file.path, image_type])
+    return {'mtime': mtime, 'images': images, 'dirs': dirs}
+
+
+def scan_image_tree(path, cache):
+    index = {}
+    paths = [path]
+    while paths:
+        path = paths.pop()
+        try:
+            entry = scan_image_dir(path, cache)
+        except FileNotFoundError:
+            continue
+        index[path] = entry
+        paths.extend(entry['dirs'])
+    return index
+
+
+def index_images(directory):
+    """Строит индекс NSER -> (путь, имя, тип) картинок пакета.
+
+    Вложенные каталоги IMG просматриваются параллельно, индекс каталогов
+    сохраняется рядом с пакетом и при следующем запуске перечитываются
+    только изменившиеся каталоги.
+    """
+    images_path = directory + "\\IMG\\"
+    index_path = os.path.join(directory, IMAGE_INDEX_NAME)
+    cache = {}
+    if IMAGE_INDEX and os.path.isfile(index_path):
+        try:
+            with open(index_path, encoding='utf-8') as index_file:
+                cache = json.load(index_file)
+        except ValueError:
+            cache = {}
+    index = {}
+    if os.path.isdir(images_path):
+        root = scan_image_dir(images_path, cache)
+        index[images_path] = root
+        with ThreadPoolExecutor(IMAGE_INDEX_WORKERS) as executor:
+            for tree in executor.map(
+                    lambda path: scan_image_tree(path, cache), root['dirs']):
+                index.update(tree)
+    if IMAGE_INDEX:
+        try:
+            with open(index_path, 'w', encoding='utf-8') as index_file:
+                json.dump(index, index_file)
+        except OSError as ex:
+            logging.warning(
+                'Индекс картинок не сохранён: {}'.format(ex))
+    images = {}
+    for entry in index.values():
+        for nser, name, image_path, image_type in entry['images']:
+            found = images.get(nser)
+            if found and found[2] == 'TIFF':  # TIF важнее JPG
+                continue
+            images[nser] = (image_path, name, image_type)
+    return images
+
+
+def read_images(directory, start, end):
+    with METRICS.timer('image_index'):
+        images = index_images(directory)
+    return {
+        nser: {
+            'IMAGE_PATH': image_path,
+            'IMAGE_NAME': name,
+            'IMAGE_TYPE': image_type
+        }
+        for nser, (image_path, name, image_type)
+        in images.items() if start <= nser < end
+    }
+
+
 @time_test
 def collect_data(directory):
-    start = 0
-    end = 1000000
+    start = NSER_START
+    end = NSER_END
     logging.info('Подготовка записей {}-{}'.format(start, end))
+    collected_data_dict = {}
     try:
-        goods_name_template = 'MD_GOOD{}.DBF'
-        mains_path = os.path.join(directory, "MD_MAINS.DBF")
         collected_data_dict = {
-            r['NSER']: dict(r) for r in sorted(
-                DBF(mains_path, ignore_missing_memofile=True),
-                key=lambda x: x['NSER']) if start <= r['NSER'] < end
+            r['NSER']: r for r in read_mains(directory, start, end)
         }
-        file_types = {'TIF': 'TIFF',
-                      'JPG': 'JPEG'}
-        for num in range(9):
-            dbf_name = goods_name_template.format(
-                "S" if num == 0 else str(num)
-            )
-            dbf_path = os.path.join(
-                directory, dbf_name)
-            if os.path.isfile(dbf_path):
-                goods = [
-                    r for r in DBF(
-                        dbf_path) if start <= r['NSER'] < end
-                ]
-                for r in goods:
-                    collected_data_dict[r['NSER']]['GOODS'] = r['GOODS']
-        for root, _, files in os.walk(directory + "\\IMG\\"):
-            for file in files:
-                if '.TIF' in file:
-                    image_path = os.path.join(root, file)
-                    name, ext = file.split('.')
-                    if start <= int(name) < end:
-                        collected_data_dict[int(name)]['IMAGE_PATH'] = image_path
-                        collected_data_dict[int(name)]['IMAGE_NAME'] = name
-                        collected_data_dict[int(name)]['IMAGE_TYPE'] = file_types[ext]
+        for nser, goods in read_goods(directory, start, end).items():
+            collected_data_dict[nser]['GOODS'] = goods
+        orphans = 0
+        for nser, image in read_images(directory, start, end).items():
+            record = collected_data_dict.get(nser)
+            if record is None:
+                orphans += 1
+                continue
+            record.update(image)
+        misses = sum(
+            1 for record in collected_data_dict.values()
+            if 'IMAGE_PATH' not in record
+        )
+        logging.info(
+            'Картинок без записи: {}, записей без картинки: {}'.format(
+                orphans, misses))
     except Exception as ex:
         exc_type, _, exc_tb = sys.exc_info()
         file_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -725,20 +2022,697 @@ def collect_data(directory):
     return collected_data_dict
 
 
+def stream_records(directory, images):
+    """Читает MD_MAINS.DBF пачками, не загружая пакет целиком.
+
+    Товары читаются для каждой пачки отдельно, по индексу NSER.
+    """
+    matched = 0
+    misses = 0
+    readers = goods_readers(directory)
+    if DBF_INDEX:
+        with METRICS.timer('dbf_index'):
+            indexes = [reader.index() for reader in readers]
+    else:
+        indexes = [None] * len(readers)
+    for chunk in chunked(read_mains(directory, NSER_START, NSER_END),
+                         STREAM_CHUNK_SIZE):
+        goods = read_chunk_goods(
+            zip(readers, indexes), [record['NSER'] for record in chunk])
+        for record in chunk:
+            nser = record['NSER']
+            if nser in goods:
+                record['GOODS'] = goods[nser]
+            image = images.get(nser)
+            if image:
+                record.update(image)
+                matched += 1
+            else:
+                misses += 1
+            yield record
+    logging.info(
+        'Картинок без записи: {}, записей без картинки: {}'.format(
+            len(images) - matched, misses))
+
+
+def load_rows(conn, storage_objects, node_no_parent_values, node_values,
+              attrs_values, superseded_inner_objects=(),
+              superseded_root_objects=()):
+    """Удаляет заменяемые объекты и заливает строки в одной транзакции."""
+    cur = conn.cursor()
+    try:
+        logging.info('Удаляем заменяемые объекты хранения')
+        delete_storage_objects(cur, list(superseded_inner_objects))
+        delete_storage_objects(cur, list(superseded_root_objects))
+        logging.info('Заливаем объекты хранения')
+        load_query_list(
+            conn, STORAGE_OBJECTS_QUERY, STORAGE_OBJECTS_COPY,
+            storage_objects, table='objects')
+        logging.info('Заливаем узлы без значений')
+        load_query_list(
+            conn, NODE_NO_PARENT_QUERY, NODE_NO_PARENT_COPY,
+            node_no_parent_values, table='nodes_no_parent')
+        logging.info('Заливаем узлы со значениями')
+        load_query_list(
+            conn, NODE_QUERY, NODE_COPY, node_values, table='nodes')
+        logging.info('Заливаем атрибуты')
+        load_query_list(
+            conn, ATTRS_QUERY, ATTRS_COPY, attrs_values, attrs_row,
+            table='attrs')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def staging_query(query):
+    for table, staging in STAGING_TABLES.items():
+        query = query.replace(table, staging)
+    return query
+
+
+def secondary_indexes(cur, table):
+    """Индексы таблицы, не обеспечивающие ограничения (PK, UNIQUE)."""
+    cur.execute("""
+        SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        WHERE i.indrelid = %s::regclass
+        AND NOT EXISTS (
+            SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid
+        )
+    """, (table,))
+    return cur.fetchall()
+
+
+def load_rows_staged(conn, storage_objects, node_no_parent_values,
+                     node_values, attrs_values, superseded_inner_objects=(),
+                     superseded_root_objects=()):
+    """Заливает строки во временные таблицы и переносит одним запросом.
+
+    Индексы "Objects"/"SearchAttributes" обновляются один раз на весь
+    пакет, а не на каждую строку. Всё выполняется в одной транзакции,
+    в лог пишется время каждого этапа.
+    """
+    cur = conn.cursor()
+    timings = LoadTimings()
+    try:
+        prepare_staging(cur)
+        timings.mark('подготовка')
+        for table, query, copy_query, values_list, row_format in \
+                staging_phases(storage_objects, node_no_parent_values,
+                               node_values, attrs_values):
+            load_query_list(
+                conn, staging_query(query), staging_query(copy_query),
+                values_list, row_format, 'staging_' + table)
+        timings.mark('залив во временные таблицы')
+        move_staging(cur, superseded_inner_objects, superseded_root_objects,
+                     timings)
+        conn.commit()
+        timings.mark('фиксация')
+    except Exception:
+        conn.rollback()
+        raise
+    logging.info('Залив через временные таблицы: {}'.format(timings))
+
+
+class LoadTimings:
+    """Время этапов загрузки для одной сводной строки лога."""
+
+    def __init__(self):
+        self.phases = []
+        self.started = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append('{} {:.1f} с'.format(phase, now - self.started))
+        self.started = now
+
+    def __str__(self):
+        return ', '.join(self.phases)
+
+
+def prepare_staging(cur):
+    for table, staging in STAGING_TABLES.items():
+        cur.execute(
+            'CREATE UNLOGGED TABLE IF NOT EXISTS {} '
+            '(LIKE {} INCLUDING DEFAULTS)'.format(staging, table))
+        cur.execute('TRUNCATE {}'.format(staging))
+
+
+def staging_phases(storage_objects, node_no_parent_values, node_values,
+                   attrs_values):
+    return (
+        ('objects', STORAGE_OBJECTS_QUERY, STORAGE_OBJECTS_COPY,
+         storage_objects, None),
+        ('nodes_no_parent', NODE_NO_PARENT_QUERY, NODE_NO_PARENT_COPY,
+         node_no_parent_values, None),
+        ('nodes', NODE_QUERY, NODE_COPY, node_values, None),
+        ('attrs', ATTRS_QUERY, ATTRS_COPY, attrs_values, attrs_row),
+    )
+
+
+def move_staging(cur, superseded_inner_objects, superseded_root_objects,
+                 timings):
+    """Удаляет заменяемые объекты и переносит строки временных таблиц.
+
+    Выполняется в транзакции вызывающего. Скорость переноса в каждую
+    основную таблицу пишется в лог и в метрики move_<таблица>: это
+    скорость записи в индексированные таблицы сервера.
+    """
+    delete_storage_objects(cur, list(superseded_inner_objects))
+    delete_storage_objects(cur, list(superseded_root_objects))
+    timings.mark('удаление')
+    indexes = []
+    if STAGING_DROP_INDEXES:
+        for table in STAGING_TABLES:
+            for name, definition in secondary_indexes(cur, table):
+                cur.execute('DROP INDEX {}'.format(name))
+                indexes.append(definition)
+        timings.mark('удаление {} индексов'.format(len(indexes)))
+    for table, staging in STAGING_TABLES.items():
+        started = time.perf_counter()
+        cur.execute(
+            'INSERT INTO {} SELECT * FROM {}'.format(table, staging))
+        elapsed = time.perf_counter() - started
+        rows = max(cur.rowcount, 0)
+        METRICS.add_time('move_' + table.strip('"'), elapsed, rows)
+        logging.info(
+            'Перенос в {}: {} строк за {:.1f} с, {:.0f} строк/с'.format(
+                table, rows, elapsed, rows / elapsed if elapsed else 0))
+    timings.mark('перенос')
+    for definition in indexes:
+        cur.execute(definition)
+    if indexes:
+        timings.mark('пересоздание индексов')
+    for staging in STAGING_TABLES.values():
+        cur.execute('TRUNCATE {}'.format(staging))
+
+
+def load_chunk(query, copy_query, values_list, table_name, number, total,
+               row_format=None, table='rows'):
+    conn, _ = connect_to_database(local=False)
+    started = time.perf_counter()
+    try:
+        load_query_list(
+            conn, query, copy_query, values_list, row_format, table)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_connection(conn)
+    elapsed = time.perf_counter() - started
+    logging.info(
+        'Пачка {} {}/{} во временную таблицу: {} строк за {:.1f} с, '
+        '{:.0f} строк/с'.format(
+            table_name, number, total, len(values_list), elapsed,
+            len(values_list) / elapsed if elapsed else 0)
+    )
+
+
+def load_rows_parallel(storage_objects, node_no_parent_values, node_values,
+                       attrs_values, superseded_inner_objects=(),
+                       superseded_root_objects=()):
+    """Заливает строки пачками по LOAD_CONNECTIONS соединениям.
+
+    Пачки параллельно заливаются во временные таблицы, каждая в своей
+    транзакции. Удаление заменяемых объектов и перенос в основные таблицы
+    идут одной транзакцией, так что при сбое основные таблицы не меняются,
+    а недолитые временные очищаются при следующей загрузке. Параллелен
+    только залив во временные таблицы, скорость основных таблиц
+    показывает move_staging().
+    """
+    connections = min(LOAD_CONNECTIONS, POOL_MAX_SIZE - 1)
+    if connections < 1:
+        raise ValueError(
+            'Для параллельной загрузки нужен POOL_MAX_SIZE не меньше 2')
+    conn, cur = connect_to_database(local=False)
+    timings = LoadTimings()
+    try:
+        prepare_staging(cur)
+        conn.commit()
+        timings.mark('подготовка')
+        table_names = {
+            'objects': 'объекты хранения',
+            'nodes_no_parent': 'узлы без значений',
+            'nodes': 'узлы со значениями',
+            'attrs': 'атрибуты',
+        }
+        with ThreadPoolExecutor(
+                connections, thread_name_prefix='Загрузка') as executor:
+            futures = []
+            for table, query, copy_query, values_list, row_format in \
+                    staging_phases(storage_objects, node_no_parent_values,
+                                   node_values, attrs_values):
+                chunks = list(chunked(values_list, LOAD_CHUNK_SIZE))
+                futures += [
+                    executor.submit(
+                        load_chunk, staging_query(query),
+                        staging_query(copy_query), chunk, table_names[table],
+                        number, len(chunks), row_format, 'staging_' + table)
+                    for number, chunk in enumerate(chunks, 1)
+                ]
+            for future in futures:
+                future.result()
+        timings.mark('залив во временные таблицы ({} соединений)'.format(
+            connections))
+        move_staging(cur, superseded_inner_objects, superseded_root_objects,
+                     timings)
+        conn.commit()
+        timings.mark('фиксация')
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_connection(conn)
+    logging.info('Параллельный залив: {}'.format(timings))
+
+
+def load_batch(batch):
+    load_all(
+        batch.storage_objects, batch.node_no_parent_values,
+        batch.node_values, batch.attrs_values,
+        batch.superseded_inner_objects, batch.superseded_root_objects
+    )
+
+
+def load_batches(batches, errors):
+    """Заливает пачки строк из очереди, пока не придёт None."""
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        if errors:
+            continue  # вычитываем очередь, чтобы не блокировать чтение
+        try:
+            load_batch(batch)
+        except Exception as ex:
+            errors.append(ex)
+            exc_type, _, exc_tb = sys.exc_info()
+            file_name = os.path.split(
+                exc_tb.tb_frame.f_code.co_filename)[1]
+            logging.error(ERROR_STRING.format(
+                exc_type, file_name, exc_tb.tb_lineno, ex))
+
+
 @time_test
-def migrate():
-    collected_data_dict = collect_data("{}{}".format(IMPORT_DIRECTORY, DB_FILE))
+def migrate_stream(directory):
+    if CHECKPOINT:
+        raise ValueError(
+            'Потоковый режим (PIPELINE_MODE = stream) '
+            'несовместим с CHECKPOINT')
+    logging.info('Потоковая миграция записей {}-{}'.format(
+        NSER_START, NSER_END))
+    images = read_images(directory, NSER_START, NSER_END)
+    records = stream_records(directory, images)
+    updated = {}
+    if DELTA:
+        fingerprints = load_fingerprints()
+        records = changed_records(records, fingerprints, updated)
+    batches = queue.Queue(STREAM_QUEUE_SIZE)
+    errors = []
+    completed = []
+    # обработчики создаются до загрузчика: при ошибке в create_executor()
+    # не остаётся потока, ждущего очереди
+    executor = create_executor()
+    progress = Progress()
+    progress.start()
+    loader = threading.Thread(
+        target=load_batches, args=(batches, errors), name='Загрузка')
+    try:
+        loader.start()
+        for chunk in chunked(records, STREAM_CHUNK_SIZE):
+            known = prefetch({record['NSER']: record for record in chunk})
+            for batch in transform(chunk, executor, known):
+                completed.extend(batch.completed)
+                batches.put(batch)
+                progress.add(batch)
+            if errors:
+                break
+    finally:
+        if loader.is_alive():
+            batches.put(None)
+            loader.join()
+        shutdown_executor(executor)
+        progress.stop()
+        update_counts(progress.counts)
+    if errors:
+        raise errors[0]
+    if updated:
+        fingerprints.update(completed_fingerprints(updated, completed))
+        save_fingerprints(fingerprints)
+
+
+def load_all(storage_objects, node_no_parent_values, node_values,
+             attrs_values, superseded_inner_objects, superseded_root_objects):
+    """Заливает строки выбранным способом, основные таблицы - атомарно."""
+    rows = (storage_objects, node_no_parent_values, node_values,
+            attrs_values, superseded_inner_objects, superseded_root_objects)
+    if LOAD_CONNECTIONS > 1:
+        load_rows_parallel(*rows)
+        return
+    conn, _ = connect_to_database(local=False)
+    try:
+        if STAGING_LOAD:
+            load_rows_staged(conn, *rows)
+        else:
+            load_rows(conn, *rows)
+    finally:
+        release_connection(conn)
+
+
+def load_fingerprints():
+    """Отпечатки записей с прошлой миграции пакета: NSER -> отпечаток."""
+    if not os.path.isfile(DELTA_FILE):
+        return {}
+    with open(DELTA_FILE, encoding='utf-8') as delta_file:
+        saved = json.load(delta_file)
+    if saved.get('jpeg_quality') != JPEG_QUALITY:
+        logging.warning(
+            'Отпечатки {} сняты с другими настройками, '
+            'все записи будут перенесены заново'.format(DELTA_FILE))
+        return {}
+    return {int(nser): entry for nser, entry in saved['records'].items()}
+
+
+def save_fingerprints(fingerprints):
+    os.makedirs(os.path.dirname(DELTA_FILE), exist_ok=True)
+    temp = DELTA_FILE + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as delta_file:
+        json.dump({'jpeg_quality': JPEG_QUALITY, 'records': fingerprints},
+                  delta_file)
+    os.replace(temp, DELTA_FILE)
+
+
+def completed_fingerprints(updated, completed):
+    """Новые отпечатки только записей, строки которых построены без ошибок.
+
+    Записи с ошибкой обработки или конвертации картинки остаются
+    с прежним отпечатком и переносятся при следующем запуске.
+    """
+    return {nser: updated[nser] for nser in completed if nser in updated}
+
+
+def fingerprint_fields():
+    return sorted(mains_fields()) + ['IMAGE_NAME']
+
+
+def record_fingerprint(record, previous=None, fields=None):
+    """Отпечаток записи: поля DBF, GOODS и содержимое картинки.
+
+    Хэшируются все поля mains_fields() в порядке имён. Возвращает
+    [хэш, размер, mtime_ns, хэш картинки]. Хэш картинки берётся из
+    прошлого отпечатка, если размер и время изменения файла те же,
+    иначе файл читается заново.
+    """
+    image_path = record.get('IMAGE_PATH')
+    size = mtime = image_digest = None
+    if image_path:
+        stat = os.stat(image_path)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+        if previous and previous[1:3] == [size, mtime]:
+            image_digest = previous[3]
+        else:
+            image_digest = file_digest(image_path)
+    digest = hashlib.sha256()
+    for field in fields or fingerprint_fields():
+        digest.update(repr(record.get(field)).encode('utf-8'))
+        digest.update(b'\0')
+    digest.update(repr(image_digest).encode('utf-8'))
+    return [digest.hexdigest(), size, mtime, image_digest]
+
+
+def changed_records(records, fingerprints, updated):
+    """Пропускает записи, не изменившиеся с прошлой миграции.
+
+    Новые отпечатки складываются в updated, в fingerprints их
+    переносят только после фиксации загрузки.
+    """
+    skipped = 0
+    changed = 0
+    fields = fingerprint_fields()
+    for record in records:
+        nser = record['NSER']
+        previous = fingerprints.get(nser)
+        try:
+            fingerprint = record_fingerprint(record, previous, fields)
+        except OSError as ex:
+            logging.warning('Нет отпечатка NSER {}: {}'.format(nser, ex))
+            changed += 1
+            yield record
+            continue
+        if previous and previous[0] == fingerprint[0]:
+            skipped += 1
+            continue
+        updated[nser] = fingerprint
+        changed += 1
+        yield record
+    logging.info('Записей без изменений: {}, к переносу: {}'.format(
+        skipped, changed))
+
+
+def load_checkpoint():
+    state = {'package': PACKAGE, 'db_file': DB_FILE,
+             'range_size': CHECKPOINT_RANGE_SIZE, 'done': []}
+    if not os.path.isfile(CHECKPOINT_FILE):
+        return state
+    with open(CHECKPOINT_FILE, encoding='utf-8') as checkpoint_file:
+        saved = json.load(checkpoint_file)
+    if all(saved.get(key) == state[key]
+           for key in ('package', 'db_file', 'range_size')):
+        return saved
+    logging.warning(
+        'Контрольная точка {} от другого пакета или размера диапазона, '
+        'миграция начнётся сначала'.format(CHECKPOINT_FILE))
+    return state
+
+
+def save_checkpoint(state):
+    os.makedirs(os.path.dirname(CHECKPOINT_FILE), exist_ok=True)
+    temp = CHECKPOINT_FILE + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as checkpoint_file:
+        json.dump(state, checkpoint_file)
+    os.replace(temp, CHECKPOINT_FILE)
+
+
+def collect_range(directory, start, end, goods, images):
+    """Собирает записи диапазона NSER вместе с товарами и картинками."""
+    collected_data_dict = {
+        r['NSER']: r for r in read_mains(directory, start, end)
+    }
+    for nser, record in collected_data_dict.items():
+        if nser in goods:
+            record['GOODS'] = goods[nser]
+        image = images.get(nser)
+        if image:
+            record.update(image)
+    return collected_data_dict
+
+
+@time_test
+def migrate_checkpointed(directory):
+    """Переносит пакет диапазонами NSER, запоминая завершённые.
+
+    Каждый диапазон заливается одной транзакцией, после фиксации он
+    записывается в CHECKPOINT_FILE. При перезапуске готовые диапазоны
+    не читаются и не обрабатываются. После полного переноса файл
+    удаляется.
+    """
+    state = load_checkpoint()
+    done = set(state['done'])
+    if done:
+        logging.info('Продолжаем миграцию, готово диапазонов: {}'.format(
+            len(done)))
+    goods = read_goods(directory, NSER_START, NSER_END)
+    images = read_images(directory, NSER_START, NSER_END)
+    fingerprints = load_fingerprints() if DELTA else None
+    fingerprinted = 0
+    executor = create_executor()
+    progress = Progress()
+    progress.start()
+    try:
+        for start in range(NSER_START, NSER_END, CHECKPOINT_RANGE_SIZE):
+            if start in done:
+                continue
+            end = min(start + CHECKPOINT_RANGE_SIZE, NSER_END)
+            collected_data_dict = collect_range(
+                directory, start, end, goods, images)
+            updated = {}
+            if DELTA:
+                collected_data_dict = {
+                    record['NSER']: record for record in changed_records(
+                        collected_data_dict.values(), fingerprints, updated)
+                }
+            if collected_data_dict:
+                known = prefetch(collected_data_dict)
+                rows = RowBatch()
+                for batch in transform(
+                        collected_data_dict.values(), executor, known):
+                    rows.extend(batch)
+                    progress.add(batch)
+                load_all(
+                    rows.storage_objects, rows.node_no_parent_values,
+                    rows.node_values, rows.attrs_values,
+                    rows.superseded_inner_objects,
+                    rows.superseded_root_objects
+                )
+                if updated:
+                    accepted = completed_fingerprints(updated, rows.completed)
+                    fingerprints.update(accepted)
+                    fingerprinted += len(accepted)
+            state['done'].append(start)
+            save_checkpoint(state)
+            logging.info('Диапазон {}-{} ({} записей) перенесён'.format(
+                start, end, len(collected_data_dict)))
+    finally:
+        shutdown_executor(executor)
+        progress.stop()
+        update_counts(progress.counts)
+        if fingerprinted:
+            # один раз за прогон: отпечатки уже залитых диапазонов
+            save_fingerprints(fingerprints)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(CHECKPOINT_FILE)
+
+
+def migrate_batch(directory):
+    collected_data_dict = collect_data(directory)
+    updated = {}
+    if DELTA:
+        fingerprints = load_fingerprints()
+        collected_data_dict = {
+            record['NSER']: record for record in changed_records(
+                collected_data_dict.values(), fingerprints, updated)
+        }
+    prefetch(collected_data_dict)
     import_data(collected_data_dict)
-    logging.info('Заливаем объекты хранения')
-    execute_query_list(STORAGE_OBJECTS_QUERY, STORAGE_OBJECTS)
-    logging.info('Заливаем узлы без значений')
-    execute_query_list(NODE_NO_PARENT_QUERY, NODE_NO_PARENT_VALUES)
-    logging.info('Заливаем узлы со значениями')
-    execute_query_list(NODE_QUERY, NODE_VALUES)
-    logging.info('Заливаем атрибуты')
-    execute_query_list(ATTRS_QUERY, ATTRS_VALUES)
-    logging.info('Миграция завершена')
+    load_all(
+        STORAGE_OBJECTS, NODE_NO_PARENT_VALUES, NODE_VALUES,
+        ATTRS_VALUES, SUPERSEDED_INNER_OBJECTS, SUPERSEDED_ROOT_OBJECTS
+    )
+    if updated:
+        fingerprints.update(
+            completed_fingerprints(updated, COMPLETED_RECORDS))
+        save_fingerprints(fingerprints)
+
+
+@time_test
+def migrate():
+    directory = "{}{}".format(IMPORT_DIRECTORY, DB_FILE)
+    if STAGING_DROP_INDEXES and (PIPELINE_MODE == 'stream' or CHECKPOINT):
+        raise ValueError(
+            'STAGING_DROP_INDEXES несовместим с потоковым режимом и '
+            'CHECKPOINT: индексы пересоздавались бы при каждой загрузке')
+    METRICS.started = time.perf_counter()
+    try:
+        if PIPELINE_MODE == 'stream':
+            migrate_stream(directory)
+        elif CHECKPOINT:
+            migrate_checkpointed(directory)
+        else:
+            migrate_batch(directory)
+        logging.info('Миграция завершена')
+    finally:
+        close_pools()
+        evict_image_cache()
+        export_metrics()
+
+
+class StackSampler:
+    """Периодически снимает стеки всех потоков процесса.
+
+    Результат пишется в формате collapsed stacks (flamegraph.pl,
+    speedscope): поток;функция;...;функция число_снимков.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(
+            target=self.run, name='Профилировщик', daemon=True)
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {
+                thread.ident: thread.name.split('_')[0]
+                for thread in threading.enumerate()
+            }
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as profile_file:
+            for stack, count in self.stacks.most_common():
+                profile_file.write('{} {}\n'.format(stack, count))
+
+
+def run_migration(profile=None):
+    """Запускает migrate(), при необходимости под профилировщиком.
+
+    cProfile видит только свой поток, поэтому записи обрабатываются
+    последовательно и картинки конвертируются в том же потоке.
+    Результат пишется рядом с логами.
+    """
+    global EXECUTOR_MODE, IMAGE_MODE
+    setup_logging()
+    if not profile:
+        migrate()
+        return
+    path = '{}{}_{}'.format(
+        PROFILE_DIRECTORY, PACKAGE,
+        datetime.datetime.now().strftime("%Y-%m-%d_%H-%M"))
+    if profile == 'cprofile':
+        EXECUTOR_MODE = 'serial'
+        IMAGE_MODE = 'inline'
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(migrate)
+        finally:
+            profiler.dump_stats(path + '.pstats')
+            with open(path + '.profile.txt', 'w',
+                      encoding='utf-8') as profile_file:
+                pstats.Stats(profiler, stream=profile_file).sort_stats(
+                    'cumulative').print_stats(50)
+            logging.info('Профиль cProfile сохранён в {}.pstats'.format(
+                path))
+    elif profile == 'sample':
+        sampler = StackSampler(PROFILE_INTERVAL)
+        sampler.start()
+        try:
+            migrate()
+        finally:
+            sampler.stop()
+            sampler.dump(path + '.collapsed')
+            logging.info('{} снимков стеков сохранено в {}.collapsed'.format(
+                sampler.samples, path))
+    else:
+        raise ValueError('Неизвестный профилировщик: {}'.format(profile))
 
 
 if __name__ == '__main__':
-    migrate()
+    parser = argparse.ArgumentParser(description='Миграция пакета в БД')
+    parser.add_argument(
+        '--profile', choices=('cprofile', 'sample'), default=PROFILE or None,
+        help='профилировать миграцию (или MIGRATION_PROFILE)')
+    run_migration(parser.parse_args().profile)